@@ -1,14 +1,42 @@
 import argparse
+import bz2
+import collections
+import cProfile
+import gzip
+import hashlib
+import hmac
 import importlib.util
+import inspect
+import itertools
 from math import ceil
+from operator import itemgetter
+import heapq
+import lzma
+import bisect
+import mmap
+import pstats
+import statistics
 import sys
 import os
 import json
 import uuid
+import secrets
 import socket
+import socketserver
+import threading
+import time
+import traceback
+import shutil
+import struct
+import zlib
 from datetime import datetime
-from fabric import Connection
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Fabric is only needed to run tasks on remote nodes over SSH, jobs in local mode run without it
+try:
+    from fabric import Connection
+except ImportError:
+    Connection = None
 
 class Config:
     def __init__(self, config_path, config_json):
@@ -21,45 +49,178 @@ class Config:
         self.input_path = os.path.join(current_folder, config_json.get('input_path'))
         self.nodes = config_json.get('nodes')
         self.tmp_folder = os.path.join(current_folder, config_json.get('tmp_folder'))
+        # Folder of the intermediate files of the running job. The driver creates a workspace in tmp_folder for every job,
+        # and a task uses the folder of its output file, so jobs that share tmp_folder never touch each other's files
+        self.work_folder = self.tmp_folder
         self.mr = None
         self.local = config_json.get('local')
+        # Number of worker processes that run tasks in local mode
+        self.local_workers = config_json.get('local_workers') or os.cpu_count()
+        # Process pools of local mode, by pool name. Pipelined jobs run reduce tasks in their own pool
+        self.local_pools = {}
+        # Port of the persistent worker daemons. When set, tasks are sent to the workers instead of being started over SSH
+        self.worker_port = config_json.get('worker_port')
+        # Address the worker daemons listen on. start_workers binds every daemon to the address of its node
+        self.worker_bind = config_json.get('worker_bind', 'localhost')
+        # Worker daemons only run requests that carry the secret token in this file, which only its owner can read
+        self.worker_token_file = os.path.join(current_folder, config_json['worker_token_file']) if 'worker_token_file' in config_json else os.path.join(self.tmp_folder, "worker.token")
+        # Number of tasks a node runs at the same time
+        self.slots_per_node = config_json.get('slots_per_node', 1)
+        # When set, the input is split into at least this many map tasks per slot, so fast nodes can take over work from slow ones
+        self.tasks_per_slot = config_json.get('tasks_per_slot')
+        # Speculative execution: once speculation_threshold of the tasks in a phase are done, a task that has run
+        # speculation_slowdown times longer than the median task gets a backup attempt on an idle slot
+        self.speculative_execution = config_json.get('speculative_execution', False)
+        self.speculation_threshold = config_json.get('speculation_threshold', 0.75)
+        self.speculation_slowdown = config_json.get('speculation_slowdown', 1.5)
+        # Number of times a task is run before the job fails. A failed task is retried on another node when there is one
+        self.task_attempts = config_json.get('task_attempts', 3)
+        # Manifest of the running job in its workspace, set by the driver so the scheduler records the committed tasks
+        self.manifest = None
+        # Iterative jobs: the reducer output of one iteration is the map input of the next. The job stops after 'iterations'
+        # iterations, or earlier when the convergence_delta counter of an iteration is below convergence_threshold
+        self.iterations = config_json.get('iterations', 1)
+        self.convergence_threshold = config_json.get('convergence_threshold')
+        # Schimmy pattern for iterative jobs whose MR module has a 'structure' function: instead of shuffling the structure
+        # records (the PageRank adjacency lists) every iteration, each reducer reads them from its own output partition of
+        # the previous iteration, which is partitioned and sorted like its shuffle input
+        self.schimmy = config_json.get('schimmy', True)
         self.input_scale = config_json.get('input_scale')
         self.output_file = os.path.join(current_folder, config_json.get('output_file'))
+        # Map output cache: the sorted output of every map task over the text input is kept in map_cache_folder, keyed by
+        # the content of its split, the MR module source and the serializer, so reruns of a job skip mapping unchanged splits.
+        # The least recently used entries are removed when the cache is larger than map_cache_mb
+        self.map_cache = config_json.get('map_cache', False)
+        self.map_cache_folder = os.path.join(current_folder, config_json['map_cache_folder']) if 'map_cache_folder' in config_json else os.path.join(self.tmp_folder, "map_cache")
+        self.map_cache_mb = config_json.get('map_cache_mb', 1024)
+        # Pipelining: reduce tasks start when reduce_slowstart of the map tasks are done, in their own slots, and merge the
+        # map outputs in groups of premerge_files while the remaining map tasks run
+        self.pipeline = config_json.get('pipeline', False)
+        self.reduce_slowstart = config_json.get('reduce_slowstart', 0.05)
+        self.premerge_files = config_json.get('premerge_files', 4)
+        # Set with --profile: every task runs under cProfile and the driver merges the profiles of each phase
+        self.profile = False
+        # Memory budget for the shuffle: sorted runs are spilled to disk once this many bytes are buffered
+        self.sort_buffer_mb = config_json.get('sort_buffer_mb', 64)
+        # Maximum number of sorted runs merged at once
+        self.merge_factor = config_json.get('merge_factor', 64)
+        # Text input is mapped in blocks of about map_batch_kb with the 'mapper_batch' function of the MR module, when it has
+        # one and map_batch is set. Otherwise every line is mapped on its own with 'mapper'
+        self.map_batch = config_json.get('map_batch', True)
+        self.map_batch_kb = config_json.get('map_batch_kb', 1024)
+        # Number of mapper outputs buffered in memory before they are aggregated by the combiner
+        self.combine_buffer_records = config_json.get('combine_buffer_records', 10000)
+        # Record format of the intermediate files, one of the keys in SERIALIZERS
+        self.serializer = config_json.get('serializer', 'binary')
+        # Skew handling, one of SKEW_STRATEGIES. The driver samples the map output before the job to find heavy keys:
+        # "salt" spreads them over all reducers and merges their partial results in a second reduce stage,
+        # "range" partitions the keys into sampled ranges of about the same number of records instead of hashing them
+        self.skew_strategy = config_json.get('skew_strategy', 'none')
+        # Number of input lines mapped for the sample, taken evenly from the start of every split
+        self.skew_sample_lines = config_json.get('skew_sample_lines', 10000)
+        # A key is heavy when its share of the sample is above this fraction of the fair share of one reducer
+        self.skew_threshold = config_json.get('skew_threshold', 0.5)
+
+        # Compression codec of the intermediate files, 'none' or one of the keys in CODECS
+        self.compression = config_json.get('compression', 'none')
+
+        # Final output: "merged" into output_file as one JSON array, or "partitioned" to keep the reducer outputs as they are,
+        # with output_file as a manifest listing them
+        self.output_mode = config_json.get('output_mode', 'merged')
+        # Order of the merged output, one of OUTPUT_ORDERS, and the number of records kept when it is sorted by value
+        self.output_order = config_json.get('output_order', 'none')
+        self.output_top_k = config_json.get('output_top_k')
+
+        if self.serializer not in SERIALIZERS:
+            print(f"Unknown serializer: {self.serializer}")
+            sys.exit(1)
+
+        if self.compression != 'none' and self.compression not in CODECS:
+            print(f"Unknown compression codec: {self.compression}")
+            sys.exit(1)
+
+        if self.output_mode not in OUTPUT_MODES or self.output_order not in OUTPUT_ORDERS:
+            print(f"Unknown output mode or order: {self.output_mode}, {self.output_order}")
+            sys.exit(1)
+
+        if self.output_top_k is not None and self.output_order != 'value':
+            print("output_top_k can only be used with \"output_order\": \"value\"")
+            sys.exit(1)
+
+        if self.skew_strategy not in SKEW_STRATEGIES:
+            print(f"Unknown skew strategy: {self.skew_strategy}")
+            sys.exit(1)
 
         if not os.path.exists(self.tmp_folder):
             os.makedirs(self.tmp_folder)
 
+        if self.map_cache:
+            os.makedirs(self.map_cache_folder, exist_ok=True)
+
 
 def list_and_split_input(config):
     input_path = config.input_path
-    n_chunks = config.mappers
+    n_chunks = number_of_map_tasks(config)
 
     if os.path.isdir(input_path):
-        print(f"Input files folder not found: {input_path}")
-        sys.exit(1)
-
-        files = [os.path.join(input_path, f) for f in os.listdir(input_path) if os.path.isfile(os.path.join(input_path, f))]
-        files = files * config.input_scale
+        files = sorted(os.path.join(input_path, f) for f in os.listdir(input_path) if not f.startswith('.') and os.path.isfile(os.path.join(input_path, f)))
+        if not files:
+            print(f"No input files in folder: {input_path}")
+            sys.exit(1)
 
-        return split_file_list(files, n_chunks)
+        return split_files(files, n_chunks, config)
     elif os.path.isfile(input_path):
-        return split_file(input_path, config.mappers, config)
+        return split_files([input_path], n_chunks, config)
     else:
         print(f"Input path not found: {input_path}")
         sys.exit(1)
 
-def split_file(file, n_chunks, config):
-    file_handles = [open(os.path.join(config.tmp_folder, f"tmp_input_{os.path.basename(file)}_part_{i}"), 'w') for i in range(n_chunks)]
+# Returns the offset of the first line that starts at or after offset
+def next_line_start(file, offset):
+    if offset == 0:
+        return 0
+    with open(file, 'rb') as f:
+        f.seek(offset - 1)
+        f.readline()
+        return f.tell()
+
+# Splits are logical: each one is a list of byte ranges of the input files aligned to line boundaries, so the input is
+# never rewritten. The files are treated as one stream, repeated input_scale times, that is cut into n_chunks parts of
+# about the same number of bytes: large files are broken into several ranges and small files are packed together
+def split_files(files, n_chunks, config):
+    sizes = [os.path.getsize(file) for file in files]
+    total = sum(sizes) * config.input_scale
+
+    chunks = [[] for _ in range(n_chunks)]
+    chunk = 0
+    offset = 0  # position in the stream of all files
+
+    for _ in range(config.input_scale):
+        for file, size in zip(files, sizes):
+            start = 0
+            while start < size:
+                chunk_end = total * (chunk + 1) // n_chunks
+                if chunk == n_chunks - 1 or offset + size - start <= chunk_end:
+                    end = size
+                else:
+                    # The cut is always after start, so every range has at least one line
+                    end = min(next_line_start(file, max(start + chunk_end - offset, start + 1)), size)
+
+                chunks[chunk].append(input_range(file, start, end))
+                offset += end - start
+                start = end
+                # A long line can cross several chunk boundaries, the chunks it skipped stay empty
+                while chunk < n_chunks - 1 and offset >= total * (chunk + 1) // n_chunks:
+                    chunk += 1
 
-    for i in range(config.input_scale):
-        with open(file, 'r') as f:
-            for i, line in enumerate(f):
-                file_handles[i % n_chunks].write(line)
+    return chunks
 
-    for fh in file_handles:
-        fh.close()
+def input_range(file, start, end):
+    return f"{os.path.abspath(file)}:{start}:{end}"
 
-    return [[os.path.abspath(fh.name)] for fh in file_handles]
+def parse_input_range(spec):
+    file, start, end = spec.rsplit(':', 2)
+    return file, int(start), int(end)
 
 def split_file_list(files, n_chunks):
     chunk_size = len(files) // n_chunks
@@ -93,52 +254,673 @@ def load_mr_module(config):
     module_name = os.path.splitext(os.path.basename(module_path))[0]
     spec = importlib.util.spec_from_file_location(module_name, module_path)
     module = importlib.util.module_from_spec(spec)
+    # Counters are reported by the MR module through increment_counter(name, amount)
+    module.increment_counter = increment_counter
     sys.modules[module_name] = module
     spec.loader.exec_module(module)
 
-    assert hasattr(module, 'mapper'), f"The module {module_path} does not have a function named 'mapper'"
+    # 'mapper_batch' is optional, and can be used instead of 'mapper' for the text input
+    assert hasattr(module, 'mapper') or (config.map_batch and hasattr(module, 'mapper_batch')), f"The module {module_path} does not have a function named 'mapper'"
     assert hasattr(module, 'reducer'), f"The module {module_path} does not have a function named 'reducer'"
+    # A reducer with two parameters is called once per key as reducer(key, values), with a lazy iterator over the values
+    # of that key. Older modules with a single parameter get the whole partition as one list
+    config.grouped_reducer = len(inspect.signature(module.reducer).parameters) == 2
+
+    # The 'combiner' function is optional
+    if hasattr(module, 'combiner'):
+        assert callable(module.combiner), f"'combiner' in the module {module_path} is not a function"
+
+    # Iterative jobs map the reducer output records of the previous iteration with 'iteration_mapper'. When the module also
+    # has a 'structure' function, the structure record of every reducer output record is added by the framework
+    if config.iterations > 1:
+        assert hasattr(module, 'iteration_mapper'), f"The module {module_path} does not have a function named 'iteration_mapper', which is needed for iterative jobs"
+        if hasattr(module, 'structure'):
+            assert config.grouped_reducer, f"The reducer in {module_path} must take (key, values) to be used with a 'structure' function"
 
     config.mr = module
 
 
+# Counters of the task running in this process. They are written next to the task output when the task is done
+task_counters = collections.Counter()
+CONVERGENCE_COUNTER = "convergence_delta"
+
+def increment_counter(name, amount=1):
+    task_counters[name] += amount
+
+def task_stats_file(output_file):
+    return f"{os.path.splitext(output_file)[0]}.stats"
+
+def write_task_stats(output_file, stats):
+    stats_file = task_stats_file(output_file)
+    attempt_output = attempt_file(stats_file)
+    with open(attempt_output, 'w') as f:
+        json.dump(stats, f)
+    commit_file(attempt_output, stats_file)
+
+# Extra statistics of the task running in this process, written with its counters
+task_stats = {}
+
+# Sums one group of statistics, such as the counters, over the stats files of a list of tasks
+def collect_stats(output_files, name):
+    totals = collections.Counter()
+    for output_file in output_files:
+        with open(task_stats_file(output_file), 'r') as f:
+            totals.update(json.load(f).get(name, {}))
+    return totals
+
+def collect_counters(output_files):
+    return collect_stats(output_files, "counters")
+
+
 def get_random_file_name(prefix, temporary=True):
     if temporary:
         prefix = "tmp_" + prefix
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     return f"{prefix}_{timestamp}_{uuid.uuid4().hex[:8]}.json"
 
+# Intermediate files can be compressed with one of these codecs. Every codec is given by the magic bytes at the start of its
+# files, which readers use to detect the codec, and a function that opens a file in binary mode. Fast compression levels
+# are used since the files are only kept for the duration of a job. zlib uses the gzip container, which has a magic number
+CODECS = {
+    'zlib': (b"\x1f\x8b", lambda file, mode: gzip.open(file, mode, compresslevel=1)),
+    'bz2': (b"BZh", lambda file, mode: bz2.open(file, mode)),
+    'lzma': (b"\xfd7zXZ\x00", lambda file, mode: lzma.open(file, mode, preset=1 if 'w' in mode else None)),
+}
+MAX_MAGIC_LENGTH = max(len(magic) for magic, _ in CODECS.values())
+
+# Compression statistics of the task running in this process, written with its counters
+compression_stats = collections.Counter()
+
+# Wraps a compressed file to measure the CPU time spent in the codec. Writes are buffered, so the codec
+# compresses large blocks and the timing adds almost no overhead
+class CompressedFile:
+    buffer_size = 1 << 20
+
+    def __init__(self, f, file, writing):
+        self.f = f
+        self.file = file
+        self.writing = writing
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.flush_buffer()
+
+    def flush_buffer(self):
+        start = time.process_time()
+        self.f.write(self.buffer)
+        compression_stats["compress_seconds"] += time.process_time() - start
+        compression_stats["raw_bytes"] += len(self.buffer)
+        self.buffer = bytearray()
+
+    def read(self, size=-1):
+        start = time.process_time()
+        data = self.f.read(size)
+        compression_stats["decompress_seconds"] += time.process_time() - start
+        return data
+
+    # Lines are split from large blocks, so line by line reading is not slowed down by timing every line
+    def __iter__(self):
+        rest = b""
+        while True:
+            block = self.read(self.buffer_size)
+            if not block:
+                if rest:
+                    yield rest
+                return
+            lines = (rest + block).split(b"\n")
+            rest = lines.pop()
+            yield from lines
+
+    def close(self):
+        if not self.writing:
+            self.f.close()
+            return
+
+        if self.buffer:
+            self.flush_buffer()
+        start = time.process_time()
+        self.f.close()
+        compression_stats["compress_seconds"] += time.process_time() - start
+        compression_stats["compressed_bytes"] += os.path.getsize(self.file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_output(file, codec):
+    if codec == 'none':
+        return open(file, 'wb')
+    return CompressedFile(CODECS[codec][1](file, 'wb'), file, True)
+
+# The codec of a file is detected from its first bytes, so files can be read without knowing how they were written
+def open_input(file):
+    with open(file, 'rb') as f:
+        head = f.read(MAX_MAGIC_LENGTH)
+    for magic, open_codec in CODECS.values():
+        if head.startswith(magic):
+            return CompressedFile(open_codec(file, 'rb'), file, False)
+    return open(file, 'rb')
+
+
+# Intermediate files are read and written one record at a time through a serializer, so they never have to be loaded whole.
+# The JSON format writes one record per line and is easy to inspect, which is useful for debugging
+class JsonRecordWriter:
+    def __init__(self, file, codec):
+        self.f = open_output(file, codec)
+
+    def write(self, record):
+        self.f.write(json.dumps(record).encode())
+        self.f.write(b'\n')
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class JsonRecordReader:
+    def __init__(self, file):
+        self.file = file
+
+    def __iter__(self):
+        with open_input(self.file) as f:
+            for line in f:
+                yield json.loads(line)
+
+
+# The binary format writes every record as a varint length followed by the encoded record.
+# Values are tagged. Floats take 4 bytes when that is lossless and 8 otherwise, and short strings
+# (keys and page names) are written once and then referenced by their index in a string table.
+# Readers keep the table in memory while their file is open, and a merge reads many files at once, so the table is
+# bounded: once it has MAX_INTERNED_STRINGS strings, the next record starts with a reset tag and both sides clear it
+BINARY_MAGIC = b"MRB1"
+TAG_NONE, TAG_FALSE, TAG_TRUE, TAG_INT, TAG_FLOAT32, TAG_FLOAT64, TAG_STRING, TAG_NEW_STRING, TAG_STRING_REF, TAG_LIST, TAG_RESET = range(11)
+MAX_INTERNED_LENGTH = 64
+MAX_INTERNED_STRINGS = 1 << 12
+float32 = struct.Struct('<f')
+float64 = struct.Struct('<d')
+
+def encode_varint(n, out):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def decode_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+class BinaryRecordWriter:
+    def __init__(self, file, codec):
+        self.f = open_output(file, codec)
+        self.f.write(BINARY_MAGIC)
+        self.strings = {}
+
+    def encode(self, value, out):
+        value_type = type(value)
+        if value_type is str:
+            index = self.strings.get(value)
+            if index is not None:
+                out.append(TAG_STRING_REF)
+                if index < 0x80:
+                    out.append(index)
+                else:
+                    encode_varint(index, out)
+                return
+            data = value.encode()
+            if len(data) <= MAX_INTERNED_LENGTH:
+                self.strings[value] = len(self.strings)
+                out.append(TAG_NEW_STRING)
+            else:
+                out.append(TAG_STRING)
+            encode_varint(len(data), out)
+            out += data
+        elif value_type is float:
+            packed = float32.pack(value) if -3.4e38 < value < 3.4e38 else None
+            if packed is not None and float32.unpack(packed)[0] == value:
+                out.append(TAG_FLOAT32)
+                out += packed
+            else:
+                out.append(TAG_FLOAT64)
+                out += float64.pack(value)
+        elif value_type is list or value_type is tuple:
+            out.append(TAG_LIST)
+            encode_varint(len(value), out)
+            for item in value:
+                self.encode(item, out)
+        elif value_type is bool or value is None:
+            out.append(TAG_NONE if value is None else TAG_TRUE if value else TAG_FALSE)
+        elif value_type is int:
+            out.append(TAG_INT)
+            encode_varint(value << 1 if value >= 0 else (-value << 1) - 1, out)
+        elif isinstance(value, (str, int, float, list, tuple)):
+            # Subclasses such as numpy scalars or named tuples are written as their base type
+            base = str if isinstance(value, str) else float if isinstance(value, float) else int if isinstance(value, int) else list
+            self.encode(base(value), out)
+        else:
+            raise TypeError(f"Cannot serialize value of type {value_type.__name__}: {value!r}")
+
+    def write(self, record):
+        payload = bytearray()
+        if len(self.strings) >= MAX_INTERNED_STRINGS:
+            self.strings.clear()
+            payload.append(TAG_RESET)
+        self.encode(record, payload)
+        if len(payload) < 0x80:
+            self.f.write(bytes((len(payload),)))
+        else:
+            header = bytearray()
+            encode_varint(len(payload), header)
+            self.f.write(header)
+        self.f.write(payload)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class BinaryRecordReader:
+    read_size = 1 << 18
+
+    def __init__(self, file):
+        self.file = file
+
+    def decode(self, buf, pos, strings):
+        tag = buf[pos]
+        pos += 1
+        if tag == TAG_STRING_REF:
+            index = buf[pos]
+            if index < 0x80:
+                return strings[index], pos + 1
+            index, pos = decode_varint(buf, pos)
+            return strings[index], pos
+        if tag == TAG_NEW_STRING or tag == TAG_STRING:
+            length, pos = decode_varint(buf, pos)
+            value = str(buf[pos:pos + length], 'utf-8')
+            if tag == TAG_NEW_STRING:
+                strings.append(value)
+            return value, pos + length
+        if tag == TAG_FLOAT32:
+            return float32.unpack_from(buf, pos)[0], pos + 4
+        if tag == TAG_FLOAT64:
+            return float64.unpack_from(buf, pos)[0], pos + 8
+        if tag == TAG_INT:
+            n = buf[pos]
+            if n < 0x80:
+                pos += 1
+            else:
+                n, pos = decode_varint(buf, pos)
+            return (n >> 1) ^ -(n & 1), pos
+        if tag == TAG_LIST:
+            length, pos = decode_varint(buf, pos)
+            items = []
+            for _ in range(length):
+                item, pos = self.decode(buf, pos, strings)
+                items.append(item)
+            return items, pos
+        if tag == TAG_NONE:
+            return None, pos
+        if tag == TAG_TRUE or tag == TAG_FALSE:
+            return tag == TAG_TRUE, pos
+        if tag == TAG_RESET:
+            strings.clear()
+            return self.decode(buf, pos, strings)
+        raise ValueError(f"Corrupt record in {self.file}: unknown tag {tag}")
+
+    def __iter__(self):
+        strings = []
+        decode = self.decode
+        with open_input(self.file) as f:
+            if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+                raise ValueError(f"{self.file} is not a binary record file")
+
+            buf = b""
+            pos = 0
+            while True:
+                chunk = f.read(self.read_size)
+                buf = buf[pos:] + chunk
+                pos = 0
+                end = len(buf)
+
+                # Decode every complete record in the buffer, the rest is kept for the next read
+                while pos < end:
+                    length = buf[pos]
+                    start = pos + 1
+                    if length >= 0x80:
+                        try:
+                            length, start = decode_varint(buf, pos)
+                        except IndexError:
+                            break
+                    if start + length > end:
+                        break
+                    record, pos = decode(buf, start, strings)
+
+                    yield record
+
+                if not chunk:
+                    if pos < end:
+                        raise ValueError(f"Truncated record at the end of {self.file}")
+                    return
+
+
+# Serializers for the intermediate files, by the name used in the 'serializer' config field
+SERIALIZERS = {
+    'json': (JsonRecordWriter, JsonRecordReader),
+    'binary': (BinaryRecordWriter, BinaryRecordReader),
+}
+
+def record_writer(file, config):
+    return SERIALIZERS[config.serializer][0](file, config.compression)
+
+def read_records(file, config):
+    return iter(SERIALIZERS[config.serializer][1](file))
+
+def write_records(records, file, config):
+    with record_writer(file, config) as writer:
+        for record in records:
+            writer.write(record)
+
+# Task outputs are written under a name unique to the attempt and renamed into place when they are complete. The final
+# file is then always the whole output of one attempt, even when a speculative duplicate of the task runs at the same time
+def attempt_file(output_file):
+    return f"{output_file}.attempt-{uuid.uuid4().hex[:8]}"
+
+# Returns False and discards the attempt when another attempt has already committed the output
+def commit_file(attempt_output, output_file):
+    if os.path.exists(output_file):
+        os.remove(attempt_output)
+        return False
+    os.replace(attempt_output, output_file)
+    return True
+
+def read_range_lines(file, start, end):
+    with open(file, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files and file systems without mmap support are read through the file object instead
+            data = f
+
+        try:
+            data.seek(start)
+            position = start
+            while position < end:
+                line = data.readline()
+                if not line:
+                    break
+                position += len(line)
+                yield line.decode().strip()
+        finally:
+            if data is not f:
+                data.close()
+
+# Reads the lines of a byte range in blocks of about block_size bytes. Every block ends at a line boundary and is decoded
+# at once. Lines are split on \n only and stripped, like read_range_lines does, so 'mapper_batch' sees the same lines as 'mapper'
+def read_range_blocks(file, start, end, block_size):
+    with open(file, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            block = f.read(min(block_size, end - position))
+            if not block:
+                break
+            # Ranges end at a line boundary, so completing the last line never reads past the end
+            if not block.endswith(b"\n"):
+                block += f.readline()
+            position += len(block)
+            lines = block.decode().split("\n")
+            if lines[-1] == "":
+                lines.pop()
+            yield [line.strip() for line in lines]
+
+def uses_batch_mapper(config):
+    return config.map_batch and hasattr(config.mr, 'mapper_batch')
+
+# 'mapper_batch' returns a list of records like 'mapper', or columns as {"keys": [...], "values": [...]}.
+# Columns can be NumPy arrays, which are converted to Python values for the serializers
+def batch_records(output):
+    if not isinstance(output, dict):
+        return output
+    keys, values = output["keys"], output["values"]
+    if hasattr(keys, 'tolist'):
+        keys = keys.tolist()
+    if hasattr(values, 'tolist'):
+        values = values.tolist()
+    return zip(keys, values)
+
+# In-mapper aggregation: the buffer is combined when it is full, and only flushed once combining stops shrinking it
+def combine_records(records, config):
+    buffer = []
+    for record in records:
+        buffer.append(record)
+        if len(buffer) >= config.combine_buffer_records:
+            buffer = list(config.mr.combiner(buffer))
+            if len(buffer) >= config.combine_buffer_records // 2:
+                yield from buffer
+                buffer = []
+
+    if buffer:
+        yield from config.mr.combiner(buffer)
+
+# Map input is either a byte range of a text input file, mapped line by line with 'mapper', or a record file written
+# by the reducers of the previous iteration, mapped record by record with 'iteration_mapper'
+RECORDS_PREFIX = "records:"
+# Reduce input given with this prefix is a previous output partition, which the reducer reads as structure records
+STRUCTURE_PREFIX = "structure:"
+
+def record_input(file):
+    return RECORDS_PREFIX + file
+
+def structure_input(file):
+    return STRUCTURE_PREFIX + file
+
+def uses_schimmy(config):
+    return config.schimmy and hasattr(config.mr, 'structure')
+
+# Counts the records passing through, and adds the count to a statistic of the task when they are used up
+def count_records(records, name):
+    count = 0
+    for record in records:
+        count += 1
+        yield record
+    task_stats[name] = task_stats.get(name, 0) + count
+
+def map_input_bytes(spec):
+    if spec.startswith(RECORDS_PREFIX):
+        return os.path.getsize(spec[len(RECORDS_PREFIX):])
+    _, start, end = parse_input_range(spec)
+    return end - start
+
+def map_inputs(files, config):
+    shuffle_structure = hasattr(config.mr, 'structure') and not uses_schimmy(config)
+    for spec in files:
+        if spec.startswith(RECORDS_PREFIX):
+            for record in count_records(read_records(spec[len(RECORDS_PREFIX):], config), "records_in"):
+                yield from config.mr.iteration_mapper(record)
+                if shuffle_structure:
+                    yield config.mr.structure(record)
+        elif uses_batch_mapper(config):
+            file, start, end = parse_input_range(spec)
+            for lines in read_range_blocks(file, start, end, config.map_batch_kb * 1024):
+                task_stats["records_in"] = task_stats.get("records_in", 0) + len(lines)
+                yield from batch_records(config.mr.mapper_batch(lines))
+        else:
+            for line in count_records(read_range_lines(*parse_input_range(spec)), "records_in"):
+                yield from config.mr.mapper(line)
+
+# Cache key of a map task over the text input. The output of a split does not depend on the number of reducers or
+# the partitioning, so it is cached as one key-sorted run and partitioned again on every use. The key covers everything
+# that decides which records are cached: the content of the split, the MR module source, the serializer, and whether the
+# split is mapped with 'mapper' or with 'mapper_batch' and its block size, since 'mapper_batch' sees the lines in blocks
+def map_cache_key(files, config):
+    key = hashlib.sha256(b"mapreduce map cache 1\0")
+    with open(config.mr_def_path, 'rb') as f:
+        key.update(hashlib.sha256(f.read()).digest())
+    key.update(config.serializer.encode() + b"\0")
+    key.update(f"mapper_batch:{config.map_batch_kb}".encode() if uses_batch_mapper(config) else b"mapper")
+    key.update(b"\0")
+    for spec in files:
+        file, start, end = parse_input_range(spec)
+        with open(file, 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                block = f.read(min(remaining, 1 << 20))
+                if not block:
+                    break
+                key.update(block)
+                remaining -= len(block)
+        key.update(b"\0")
+    return key.hexdigest()
+
+def map_cache_file(key, config):
+    return os.path.join(config.map_cache_folder, f"{key}.run")
+
+def uses_map_cache(files, config):
+    return config.map_cache and not any(spec.startswith(RECORDS_PREFIX) for spec in files)
+
 def do_mapping(files, config, output_file):
-    with open(output_file, 'w') as of:
-        of.write('[')
-        first = True
-        for file in files:
-            with open(file, 'r') as f:
-                for line in f:
-                    output_list = config.mr.mapper(line.strip())
-                    for output in output_list:
-                        if not first:
-                            of.write(',')
-                        json.dump(output, of)
-                        first = False
-        of.write(']')
+    files, plan = task_inputs(files)
+    task_stats["bytes_in"] = sum(map_input_bytes(spec) for spec in files)
+    # The salt is derived from the task output, so every attempt of a task partitions its records the same way
+    partitioner = Partitioner(config.reducers, plan, zlib.crc32(os.path.basename(output_file).encode()))
+
+    if uses_map_cache(files, config):
+        cache_file = map_cache_file(map_cache_key(files, config), config)
+        try:
+            # The modification time is the last use, for the LRU eviction in the driver
+            os.utime(cache_file)
+            task_stats["map_cache"] = "hit"
+        except FileNotFoundError:
+            records = map_inputs(files, config)
+            if hasattr(config.mr, 'combiner'):
+                records = combine_records(records, config)
+            attempt_output = attempt_file(cache_file)
+            sort_to_file(records, attempt_output, config)
+            commit_file(attempt_output, cache_file)
+            task_stats["map_cache"] = "miss"
+        task_stats["partition_records"] = partition_sorted_records(read_records(cache_file, config), config, output_file, partitioner)
+    else:
+        records = map_inputs(files, config)
+        if hasattr(config.mr, 'combiner'):
+            records = combine_records(records, config)
+        task_stats["partition_records"] = partition_records(records, config, output_file, partitioner)
+    task_stats["records_out"] = sum(task_stats["partition_records"])
+    task_stats["bytes_out"] = sum(os.path.getsize(partition_file(output_file, i)) for i in range(config.reducers))
+
+def group_values(group):
+    for record in group:
+        yield record[1] if len(record) == 2 else record[1:]
+
+def read_structure_records(file, config):
+    for record in read_records(file, config):
+        yield config.mr.structure(record)
+
+# Salted keys were spread over all reducers, so every reducer only has a part of their values. Instead of reducing
+# them, the reducer combines its part into a partial file, and the partial files are reduced in a second stage
+def split_salted_groups(groups, salted_keys, config, partial_output):
+    with record_writer(partial_output, config) as writer:
+        for key, group in groups:
+            if json.dumps(key) in salted_keys:
+                for record in combine_records(group, config):
+                    writer.write(record)
+            else:
+                yield key, group
+
+def salted_partial_file(output_file):
+    return f"{os.path.splitext(output_file)[0]}_salted"
+
+# Reduce input of a pipelined job given with this prefix is a map output partition that may not be committed yet
+AWAIT_PREFIX = "await:"
+# Seconds between checks for new map outputs
+AWAIT_POLL_INTERVAL = 0.1
+
+def await_input(output_prefix, partition):
+    return f"{AWAIT_PREFIX}{output_prefix}:{partition}"
+
+# Written by the driver when the map phase failed, so reducers waiting for the outputs of a map task give up
+def map_abort_file(output_prefix):
+    return f"{os.path.splitext(output_prefix)[0]}.abort"
+
+# Waits for the awaited map outputs, and merges them in groups of premerge_files as they are committed, so most of the
+# merging is done while the map phase is still running. Returns the input files and the merged runs to remove afterwards
+def await_inputs(files, config):
+    ready = [file for file in files if not file.startswith(AWAIT_PREFIX)]
+    pending = [tuple(file[len(AWAIT_PREFIX):].rsplit(':', 1)) for file in files if file.startswith(AWAIT_PREFIX)]
+    arrived = []
+    runs = []
+    while pending:
+        committed = [(prefix, partition) for prefix, partition in pending if os.path.exists(partition_file(prefix, int(partition)))]
+        for task in committed:
+            pending.remove(task)
+            arrived.append(partition_file(task[0], int(task[1])))
+
+        if len(arrived) >= config.premerge_files:
+            run_file = os.path.join(config.work_folder, get_random_file_name("premerge"))
+            write_records(heapq.merge(*[read_records(file, config) for file in arrived], key=record_key), run_file, config)
+            runs.append(run_file)
+            arrived = []
+        elif not committed:
+            for prefix, _ in pending:
+                if os.path.exists(map_abort_file(prefix)):
+                    raise RuntimeError(f"Map task {prefix} failed")
+            time.sleep(AWAIT_POLL_INTERVAL)
+
+    return runs + arrived + ready, runs
 
 def do_reducing(files, config, output_file):
-    intermediate_data = []
-    for file in files:
-        with open(file, 'r') as f:
-            intermediate_data.extend(json.load(f))
+    files, plan = task_inputs(files)
+    files, premerged_runs = await_inputs(files, config)
+    salted_keys = set(plan.get("salted_keys", []))
+    task_stats["bytes_in"] = sum(os.path.getsize(file[len(STRUCTURE_PREFIX):] if file.startswith(STRUCTURE_PREFIX) else file) for file in files)
+    # Every input file is one key-sorted partition, written by a mapper or by this reducer in the previous iteration
+    inputs = [read_structure_records(file[len(STRUCTURE_PREFIX):], config) if file.startswith(STRUCTURE_PREFIX) else read_records(file, config) for file in files]
+    records = count_records(heapq.merge(*inputs, key=record_key), "records_in")
+
+    if config.grouped_reducer:
+        groups = itertools.groupby(records, key=record_key)
+        if salted_keys:
+            attempt_partial = attempt_file(salted_partial_file(output_file))
+            groups = split_salted_groups(groups, salted_keys, config, attempt_partial)
+        reduced_data = (output for key, group in groups for output in config.mr.reducer(key, group_values(group)))
+    else:
+        reduced_data = config.mr.reducer(list(records))
 
-    reduced_data = config.mr.reducer(intermediate_data)
+    attempt_output = attempt_file(output_file)
+    write_records(count_records(reduced_data, "records_out"), attempt_output, config)
+    task_stats["bytes_out"] = os.path.getsize(attempt_output)
+    if salted_keys:
+        commit_file(attempt_partial, salted_partial_file(output_file))
+    commit_file(attempt_output, output_file)
 
-    with open(output_file, 'w') as f:
-        json.dump(reduced_data, f)
+    for run_file in premerged_runs:
+        os.remove(run_file)
 
 def remote_map(node, chunk, config, output_file):
     print("Mapping on node: ", node)
     conn = Connection(node)
     remote_files = ','.join(chunk)
     script = f'python3 {os.path.abspath(__file__)} --config_path {config.config_path} --execution_mode map --intermediate_files {remote_files} --tmp_output_file {output_file}'
+    if config.profile:
+        script += ' --profile'
     result = conn.run(script, hide=False)
     return result.stdout
 
@@ -147,57 +929,776 @@ def remote_reduce(node, chunk, config, output_file):
     conn = Connection(node)
     remote_files = ','.join(chunk)
     script = f'python3 {os.path.abspath(__file__)} --config_path {config.config_path} --execution_mode reduce --intermediate_files {remote_files} --tmp_output_file {output_file}'
+    if config.profile:
+        script += ' --profile'
     result = conn.run(script, hide=False)
     return result.stdout
 
-def start_remote_operation(f, list_of_file_sets, config, output_files):
+# Every node (or every local worker process in local mode) has slots_per_node slots. Each slot pulls the next task from
+# the queue when it is done with the previous one, so fast nodes end up running more tasks than slow ones
+def scheduling_slots(config):
+    if config.local:
+        return ["localhost"] * config.local_workers
+    return [node for node in config.nodes for _ in range(config.slots_per_node)]
+
+def number_of_map_tasks(config):
+    if config.tasks_per_slot is None:
+        return config.mappers
+    return max(config.mappers, config.tasks_per_slot * len(scheduling_slots(config)))
+
+# Slots wait this many seconds for a task that prefers their node before they take tasks that prefer another node
+LOCALITY_WAIT = 1.0
+
+# Shares the slots of the nodes between the jobs of a job queue. Map and reduce tasks have their own slots on every node,
+# so the waiting reducers of a pipelined job never hold up map tasks. When a slot is free, it goes to the waiting job
+# with the fewest running tasks, and to the job that has waited longest on a tie
+class SlotAllocator:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.used = collections.Counter()
+        self.running = collections.Counter()
+        self.waiting = {}
+        self.tickets = itertools.count()
+
+    def next_in_line(self, slot):
+        return min((self.running[job], ticket) for ticket, (job, waiting_slot) in self.waiting.items() if waiting_slot == slot)[1]
+
+    def acquire(self, job, slot, capacity):
+        with self.condition:
+            ticket = next(self.tickets)
+            self.waiting[ticket] = (job, slot)
+            while self.used[slot] >= capacity or self.next_in_line(slot) != ticket:
+                self.condition.wait()
+            del self.waiting[ticket]
+            self.used[slot] += 1
+            self.running[job] += 1
+
+    def release(self, job, slot):
+        with self.condition:
+            self.used[slot] -= 1
+            self.running[job] -= 1
+            self.condition.notify_all()
+
+# Set by the job queue. Jobs run alone use the slots of their nodes without asking
+shared_slots = None
+
+class TaskScheduler:
+    def __init__(self, f, list_of_file_sets, config, output_files, phase, preferred_nodes=None):
+        self.f = f
+        self.tasks = list(zip(list_of_file_sets, output_files))
+        self.config = config
+        self.phase = phase
+        self.preferred_nodes = preferred_nodes
+        self.pending = collections.deque(range(len(self.tasks)))
+        self.nodes = [None] * len(self.tasks)
+        # Time the winning attempt of every task was sent to its node and the time it returned
+        self.timings = [None] * len(self.tasks)
+        self.elapsed = None
+        self.start_time = time.time()
+        self.running = collections.defaultdict(list)
+        self.done = set()
+        self.durations = []
+        self.results = [None] * len(self.tasks)
+        self.error = None
+        self.condition = threading.Condition()
+        self.busy_time = collections.defaultdict(float)
+        self.task_count = collections.defaultdict(int)
+        self.speculative_launched = 0
+        self.speculative_won = 0
+        # Nodes on which every task failed, a failed task is retried on another node when there is one
+        self.failed_nodes = collections.defaultdict(list)
+        self.recovered = 0
+
+        # Tasks of a resumed job that were committed before are not run again. A task is committed once its stats file exists
+        if config.manifest is not None:
+            for index, output_file in enumerate(output_files):
+                if os.path.exists(task_stats_file(output_file)):
+                    self.pending.remove(index)
+                    self.done.add(index)
+                    self.nodes[index] = config.manifest.node(output_file)
+                    self.recovered += 1
+
+    def finished(self):
+        return self.error is not None or len(self.done) == len(self.tasks)
+
+    # A straggler is a running task with a single attempt that has taken speculation_slowdown times the median task
+    def straggler(self, node):
+        if not self.config.speculative_execution or len(self.done) < self.config.speculation_threshold * len(self.tasks) or not self.durations:
+            return None
+
+        limit = self.config.speculation_slowdown * statistics.median(self.durations)
+        now = time.time()
+        for index, attempts in self.running.items():
+            if len(attempts) != 1 or index in self.done:
+                continue
+            attempt_node, started, _ = attempts[0]
+            if attempt_node == node and not self.config.local:
+                continue
+            if now - started > limit:
+                return index
+        return None
+
+    # A failed task is not run again on a node it failed on, unless it failed on all nodes
+    def runnable(self, index, node):
+        failed = self.failed_nodes[index]
+        return node not in failed or all(slot in failed for slot in scheduling_slots(self.config))
+
+    # Tasks that prefer this node come first. Tasks that prefer another node are only taken after LOCALITY_WAIT
+    def pending_task(self, node):
+        runnable = [index for index in self.pending if self.runnable(index, node)]
+        if not runnable:
+            return None
+        if self.preferred_nodes is None:
+            return runnable[0]
+
+        for index in runnable:
+            if self.preferred_nodes[index] == node:
+                return index
+        if time.time() - self.start_time > LOCALITY_WAIT:
+            return runnable[0]
+        return None
+
+    # Returns (task index, speculative) or None when the phase is over. Waits while other slots are still running tasks,
+    # since one of them may turn out to be a straggler
+    def next_task(self, node):
+        with self.condition:
+            while not self.finished():
+                index = self.pending_task(node)
+                if index is not None:
+                    self.pending.remove(index)
+                    return index, False
+
+                index = self.straggler(node)
+                if index is not None:
+                    self.speculative_launched += 1
+                    print(f"Speculatively running {self.phase.lower()} task {index} on {node}")
+                    return index, True
+
+                self.condition.wait(0.2)
+            return None
+
+    def run_slot(self, node):
+        slot = (node, self.phase)
+        capacity = scheduling_slots(self.config).count(node)
+        while True:
+            task = self.next_task(node)
+            if task is None:
+                return
+
+            index, speculative = task
+            chunk, output_file = self.tasks[index]
+            if shared_slots is not None:
+                shared_slots.acquire(self.config, slot, capacity)
+                # The phase may have failed, or the first attempt finished, while this attempt waited for a slot
+                if self.finished() or index in self.done:
+                    shared_slots.release(self.config, slot)
+                    continue
+            attempt = (node, time.time(), speculative)
+            with self.condition:
+                self.running[index].append(attempt)
+
+            # A task that calls sys.exit raises SystemExit in the slot thread. It is a failed attempt like any other error,
+            # otherwise the attempt would never finish and the phase would wait forever
+            try:
+                result = self.f(node, chunk, self.config, output_file)
+                error = None
+            except BaseException as e:
+                error = e
+            if shared_slots is not None:
+                shared_slots.release(self.config, slot)
+
+            with self.condition:
+                duration = time.time() - attempt[1]
+                self.busy_time[node] += duration
+                self.task_count[node] += 1
+                self.running[index].remove(attempt)
+
+                # The first attempt to finish wins, the outputs of later attempts are ignored
+                if index not in self.done:
+                    if error is None:
+                        self.done.add(index)
+                        self.results[index] = result
+                        self.nodes[index] = node
+                        self.timings[index] = (attempt[1], attempt[1] + duration)
+                        self.durations.append(duration)
+                        if speculative:
+                            self.speculative_won += 1
+                        if self.config.manifest is not None:
+                            self.config.manifest.task_committed(output_file, node)
+                    else:
+                        self.failed_nodes[index].append(node)
+                        # A task without another running attempt is retried until it has failed task_attempts times
+                        if not self.running[index] and self.error is None:
+                            if len(self.failed_nodes[index]) < self.config.task_attempts:
+                                print(f"{self.phase} task {index} failed on {node}, retrying ({len(self.failed_nodes[index])}/{self.config.task_attempts} attempts failed): {error}")
+                                self.pending.append(index)
+                            else:
+                                self.error = error
+                self.condition.notify_all()
+
+    def run(self):
+        slots = scheduling_slots(self.config)
+        start = self.start_time = time.time()
+
+        # Slot threads are daemons and are not joined: a losing speculative attempt may still be running when the phase is done
+        for node in slots:
+            threading.Thread(target=self.run_slot, args=(node,), daemon=True).start()
+        with self.condition:
+            while not self.finished():
+                self.condition.wait()
+
+        self.elapsed = time.time() - start
+        self.report(slots, self.elapsed)
+
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+    # Idle time of a node is the time its slots spent without a task while the phase was running
+    def report(self, slots, elapsed):
+        print(f"\n\n{self.phase} phase: {len(self.tasks)} tasks on {len(set(slots))} nodes in {elapsed:.2f}s")
+        with self.condition:
+            if self.recovered:
+                print(f"  {self.recovered} tasks committed before the job was resumed")
+            retried = sum(1 for failed in self.failed_nodes.values() if failed)
+            if retried:
+                print(f"  {retried} tasks failed on {sum(len(failed) for failed in self.failed_nodes.values())} attempts")
+            for node in sorted(set(slots)):
+                idle_time = elapsed * slots.count(node) - self.busy_time[node]
+                print(f"  {node}: {self.task_count[node]} tasks, busy {self.busy_time[node]:.2f}s, idle {idle_time:.2f}s")
+            if self.config.speculative_execution:
+                print(f"  Speculative attempts: {self.speculative_launched} launched, {self.speculative_won} finished first")
+
+# Runs one task per file set and returns the scheduler, which knows the node that ran each task
+def start_remote_operation(f, list_of_file_sets, config, output_files, phase, preferred_nodes=None):
     assert len(list_of_file_sets) == len(output_files)
 
-    with ThreadPoolExecutor() as executor:
-        futures = {executor.submit(f, config.nodes[i % len(config.nodes)], chunk, config, output_files[i]): chunk for i, chunk in enumerate(list_of_file_sets)}
-        results = []
-        for future in as_completed(futures):
-            results.append(future.result())
-    
-    return results
-
-
-def do_sort_before_reduce(files, config):
-    total_files_split = config.reducers
-
-    intermediate_data = []
-    for file in files:
-        with open(file, 'r') as f:
-            intermediate_data.extend(json.load(f))
-
-    sorted_files = [os.path.join(config.tmp_folder, get_random_file_name("sorted")) for _ in range(total_files_split)]
-    buffers = [[] for _ in range(total_files_split)]
+    if Connection is None and f in (remote_map, remote_reduce):
+        print("Error: fabric is required to run tasks on remote nodes. Install it or set \"local\": true in the config.", file=sys.stderr)
+        sys.exit(1)
 
-    for key, value in intermediate_data:
-        key_hash = hash(key) % total_files_split
-        buffers[key_hash].append((key, value))
+    scheduler = TaskScheduler(f, list_of_file_sets, config, output_files, phase, preferred_nodes)
+    scheduler.run()
+    return scheduler
+
+
+TASK_FUNCTIONS = {"map": do_mapping, "reduce": do_reducing}
+
+def task_profile_file(output_file):
+    return f"{os.path.splitext(output_file)[0]}.prof"
+
+def run_task(mode, files, config, output_file, profile=False):
+    config.work_folder = os.path.dirname(output_file)
+    task_counters.clear()
+    task_stats.clear()
+    compression_stats.clear()
+    start = time.time()
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(TASK_FUNCTIONS[mode], files, config, output_file)
+        profile_file = task_profile_file(output_file)
+        attempt_output = attempt_file(profile_file)
+        profiler.dump_stats(attempt_output)
+        commit_file(attempt_output, profile_file)
+    else:
+        TASK_FUNCTIONS[mode](files, config, output_file)
+    timing = {"host": socket.gethostname(), "start": start, "end": time.time()}
+    write_task_stats(output_file, {"counters": dict(task_counters), "compression": dict(compression_stats), **timing, **task_stats})
+
+# Config of a local worker process, loaded once when the process starts so every task reuses the imported MR module
+local_config = None
+
+def init_local_worker(config_path):
+    global local_config
+    local_config = load_config(config_path)
+    load_mr_module(local_config)
+
+def run_local_task(mode, chunk, output_file, profile):
+    run_task(mode, chunk, local_config, output_file, profile)
+
+# The pool is created on first use and shared by all phases of the job
+def get_local_pool(config, mode):
+    name = task_pool_name(mode, config)
+    if name not in config.local_pools:
+        config.local_pools[name] = ProcessPoolExecutor(max_workers=config.local_workers, initializer=init_local_worker, initargs=(config.config_path,))
+    return config.local_pools[name]
+
+# Reduce tasks of a pipelined job wait for map outputs, so they get their own pool and cannot hold up the map tasks
+def task_pool_name(mode, config):
+    return mode if config.pipeline else "tasks"
+
+def local_map(node, chunk, config, output_file):
+    return get_local_pool(config, "map").submit(run_local_task, "map", chunk, output_file, config.profile).result()
+
+def local_reduce(node, chunk, config, output_file):
+    return get_local_pool(config, "reduce").submit(run_local_task, "reduce", chunk, output_file, config.profile).result()
+
+# Persistent workers: a worker daemon runs on every node, keeps the MR module loaded in a local process pool
+# and receives task descriptors from the driver as one JSON line per connection
+def worker_address(node, config):
+    host, _, port = node.partition(':')
+    return host, int(port) if port else config.worker_port
+
+# The token is created on first use by the driver or a worker. It is written to an attempt file that only the owner can
+# read, and linked into place, so a driver and a worker starting at the same time end up with the same token
+def worker_token(config):
+    if not os.path.exists(config.worker_token_file):
+        attempt_output = attempt_file(config.worker_token_file)
+        fd = os.open(attempt_output, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(attempt_output, config.worker_token_file)
+        except FileExistsError:
+            pass
+        os.remove(attempt_output)
+
+    with open(config.worker_token_file, 'r') as f:
+        return f.read().strip()
+
+def send_worker_request(node, request, config):
+    host, port = worker_address(node, config)
+    request = {**request, "token": worker_token(config)}
+    try:
+        with socket.create_connection((host, port)) as sock:
+            sock.sendall((json.dumps(request) + '\n').encode())
+            with sock.makefile('r') as f:
+                reply = f.readline()
+    except ConnectionRefusedError:
+        raise RuntimeError(f"No worker is listening on {host}:{port}. Start the workers with --execution_mode start_workers")
+
+    if not reply:
+        raise RuntimeError(f"Worker {host}:{port} closed the connection")
+    reply = json.loads(reply)
+    if reply.get('status') != 'ok':
+        raise RuntimeError(f"Task failed on worker {host}:{port}:\n{reply.get('error')}")
+    return reply
+
+def task_request(mode, chunk, config, output_file):
+    return {"mode": mode, "config_path": os.path.abspath(config.config_path), "files": chunk, "output_file": output_file, "profile": config.profile, "pool": task_pool_name(mode, config)}
+
+def worker_map(node, chunk, config, output_file):
+    print("Mapping on worker: ", node)
+    return send_worker_request(node, task_request("map", chunk, config, output_file), config)
+
+def worker_reduce(node, chunk, config, output_file):
+    print("Reducing on worker: ", node)
+    return send_worker_request(node, task_request("reduce", chunk, config, output_file), config)
+
+class WorkerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        shutdown = False
+        try:
+            request = json.loads(line)
+            # Requests name an MR module that the worker imports and runs, so only clients that know the token are served
+            if not hmac.compare_digest(str(request.get("token", "")), self.server.token):
+                raise PermissionError("Invalid worker token")
+            if request["mode"] == "shutdown":
+                shutdown = True
+            elif request["mode"] != "ping":
+                pool = self.server.pool_for(request["config_path"], request.get("pool", "tasks"))
+                pool.submit(run_local_task, request["mode"], request["files"], request["output_file"], request.get("profile", False)).result()
+            reply = {"status": "ok", "node": socket.gethostname()}
+        except PermissionError as e:
+            reply = {"status": "error", "error": str(e)}
+        except BaseException:
+            reply = {"status": "error", "error": traceback.format_exc()}
+
+        self.wfile.write((json.dumps(reply) + '\n').encode())
+        self.wfile.flush()
+        # Only after the reply is sent, since the process exits once the server is shut down
+        if shutdown:
+            threading.Thread(target=self.server.shutdown).start()
+
+class WorkerServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, workers, token):
+        # Set before binding, since server_close is called when the address is in use
+        self.workers = workers
+        self.token = token
+        self.pools = {}
+        self.lock = threading.Lock()
+        super().__init__(address, WorkerRequestHandler)
+
+    # One process pool per job config and pool name. A pool is replaced when its config file changes, so edited configs are picked up
+    def pool_for(self, config_path, name):
+        mtime = os.path.getmtime(config_path)
+        version = (config_path, mtime, name)
+        with self.lock:
+            if version not in self.pools:
+                for old_version in [v for v in self.pools if v[0] == config_path and v[1] != mtime]:
+                    self.pools.pop(old_version).shutdown(wait=False)
+                self.pools[version] = ProcessPoolExecutor(max_workers=self.workers, initializer=init_local_worker, initargs=(config_path,))
+            return self.pools[version]
+
+    def server_close(self):
+        super().server_close()
+        for pool in self.pools.values():
+            pool.shutdown()
+
+def run_worker(config, port, host):
+    if port is None:
+        print("Error: no worker port given. Use --port or set worker_port in the config.", file=sys.stderr)
+        sys.exit(1)
 
-    for i, sorted_file in enumerate(sorted_files):
-        with open(sorted_file, 'w') as f:
-            json.dump(buffers[i], f)
+    with WorkerServer((host, port), config.local_workers, worker_token(config)) as server:
+        print(f"Worker listening on {host}:{port} with {config.local_workers} processes")
+        server.serve_forever()
 
-    return sorted_files
+def worker_nodes(config):
+    return sorted(set(config.nodes))
 
+def start_workers(config):
+    if Connection is None:
+        print("Error: fabric is required to start workers on remote nodes.", file=sys.stderr)
+        sys.exit(1)
 
-def debug_merge_json_files(files, output_file):
+    # Created before the workers start, so they all read the same token
+    worker_token(config)
+    for node in worker_nodes(config):
+        host, port = worker_address(node, config)
+        print(f"Starting worker on {host}:{port}")
+        script = f'python3 {os.path.abspath(__file__)} --config_path {os.path.abspath(config.config_path)} --execution_mode worker --port {port} --bind {host}'
+        Connection(host).run(f'nohup {script} > /tmp/mapreduce-worker-{port}.log 2>&1 < /dev/null &', hide=True)
+
+    # Wait until every worker accepts connections
+    deadline = time.time() + 30
+    for node in worker_nodes(config):
+        while True:
+            try:
+                send_worker_request(node, {"mode": "ping"}, config)
+                break
+            except (RuntimeError, OSError):
+                if time.time() > deadline:
+                    print(f"Worker on {node} did not start", file=sys.stderr)
+                    sys.exit(1)
+                time.sleep(0.5)
+
+def stop_workers(config):
+    for node in worker_nodes(config):
+        try:
+            send_worker_request(node, {"mode": "shutdown"}, config)
+            print(f"Stopped worker on {node}")
+        except (RuntimeError, OSError) as e:
+            print(f"Failed to stop worker on {node}: {e}")
+
+def start_operation(mode, list_of_file_sets, config, output_files, preferred_nodes=None):
+    if config.local:
+        f = local_map if mode == "map" else local_reduce
+    elif config.worker_port is not None:
+        f = worker_map if mode == "map" else worker_reduce
+    else:
+        f = remote_map if mode == "map" else remote_reduce
+    return start_remote_operation(f, list_of_file_sets, config, output_files, mode.capitalize(), preferred_nodes)
+
+# Losing speculative attempts may still be running when the job is done. Their output is discarded anyway, so their
+# processes are stopped instead of waited for
+def shutdown_local_pool(config):
+    for pool in config.local_pools.values():
+        processes = list((pool._processes or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+    config.local_pools = {}
+
+
+record_key = itemgetter(0)
+record_value = itemgetter(1)
+
+SKEW_STRATEGIES = ("none", "salt", "range")
+
+# Map and reduce tasks get the partition plan of the job as an input with this prefix
+PARTITIONS_PREFIX = "partitions:"
+
+def partitions_input(file):
+    return PARTITIONS_PREFIX + file
+
+# Separates the partition plan from the data inputs of a task
+def task_inputs(files):
+    inputs = []
+    plan = {}
+    for spec in files:
+        if spec.startswith(PARTITIONS_PREFIX):
+            with open(spec[len(PARTITIONS_PREFIX):], 'r') as f:
+                plan = json.load(f)
+        else:
+            inputs.append(spec)
+    return inputs, plan
+
+# Keys are hash-partitioned by default. Python's hash() is salted per process, so mappers on different nodes would
+# disagree on partitions. A partition plan from the driver replaces this with sampled key ranges, or sends the records
+# of salted keys to the partitions in turn
+class Partitioner:
+    def __init__(self, total_partitions, plan, salt=0):
+        self.total_partitions = total_partitions
+        # Partition i holds the keys after boundaries[i - 1], up to and including boundaries[i]
+        self.boundaries = plan.get("boundaries")
+        # JSON encoded, like the keys are when they are hashed
+        self.salted_keys = set(plan.get("salted_keys", []))
+        # The mappers combine their output, so each of them emits a salted key only about once. The salt starts at a
+        # different value in every map task, or every mapper would send that record to the same partition
+        self.salt = salt
+
+    def __call__(self, key):
+        if self.boundaries is not None:
+            return bisect.bisect_left(self.boundaries, key)
+
+        encoded_key = json.dumps(key)
+        partition = zlib.crc32(encoded_key.encode()) % self.total_partitions
+        if encoded_key in self.salted_keys:
+            self.salt += 1
+            partition = (partition + self.salt) % self.total_partitions
+        return partition
+
+def partition_file(output_prefix, partition):
+    return f"{os.path.splitext(output_prefix)[0]}_part_{partition}"
+
+def spill_run(buffer, config, key=record_key, reverse=False):
+    run_file = os.path.join(config.work_folder, get_random_file_name("run"))
+    start = time.time()
+    buffer.sort(key=key, reverse=reverse)
+    task_stats["sort_seconds"] = task_stats.get("sort_seconds", 0.0) + time.time() - start
+    write_records(buffer, run_file, config)
+    task_stats["spilled_runs"] = task_stats.get("spilled_runs", 0) + 1
+    return run_file
+
+# Approximate memory used by a buffered record. Nested lists are walked, since PageRank structure values hold the
+# names of all outgoing links of a page
+def record_size(record):
+    size = sys.getsizeof(record)
+    for value in record:
+        value_type = type(value)
+        size += record_size(value) if value_type is list or value_type is tuple else sys.getsizeof(value)
+    return size
+
+# k-way merge of sorted runs into one sorted file, in several passes if there are more runs than merge_factor
+def merge_runs(runs, output_file, config, key=record_key, reverse=False):
+    start = time.time()
+    while len(runs) > config.merge_factor:
+        merged_run = os.path.join(config.work_folder, get_random_file_name("run"))
+        write_records(heapq.merge(*[read_records(run, config) for run in runs[:config.merge_factor]], key=key, reverse=reverse), merged_run, config)
+        for run in runs[:config.merge_factor]:
+            os.remove(run)
+        runs = runs[config.merge_factor:] + [merged_run]
+
+    write_records(heapq.merge(*[read_records(run, config) for run in runs], key=key, reverse=reverse), output_file, config)
+    for run in runs:
+        os.remove(run)
+    task_stats["merge_seconds"] = task_stats.get("merge_seconds", 0.0) + time.time() - start
+
+# External sort of records into one file, with the same memory budget as the partitioning of the mappers
+def sort_to_file(records, output_file, config, key=record_key, reverse=False):
+    buffer_limit = config.sort_buffer_mb * 1024 * 1024
+    buffer = []
+    buffered_bytes = 0
+    runs = []
+    for record in records:
+        buffer.append(record)
+        buffered_bytes += record_size(record)
+        if buffered_bytes >= buffer_limit:
+            runs.append(spill_run(buffer, config, key, reverse))
+            buffer = []
+            buffered_bytes = 0
+    if buffer:
+        runs.append(spill_run(buffer, config, key, reverse))
+
+    merge_runs(runs, output_file, config, key, reverse)
+
+# Partitions records that are already sorted by key. Every partition gets its records in order, so nothing is sorted
+def partition_sorted_records(records, config, output_prefix, partitioner):
+    total_partitions = config.reducers
+    partition_sizes = [0] * total_partitions
+    attempt_outputs = [attempt_file(partition_file(output_prefix, i)) for i in range(total_partitions)]
+    writers = [record_writer(attempt_output, config) for attempt_output in attempt_outputs]
+
+    for record in records:
+        partition = partitioner(record[0])
+        writers[partition].write(record)
+        partition_sizes[partition] += 1
+
+    for writer in writers:
+        writer.close()
+    for i, attempt_output in enumerate(attempt_outputs):
+        commit_file(attempt_output, partition_file(output_prefix, i))
+
+    return partition_sizes
+
+# Partitions records into one key-sorted file per reducer, spilling sorted runs when the memory budget is used up.
+# Returns the number of records in every partition
+def partition_records(records, config, output_prefix, partitioner):
+    total_partitions = config.reducers
+    buffer_limit = config.sort_buffer_mb * 1024 * 1024
+
+    buffers = [[] for _ in range(total_partitions)]
+    runs = [[] for _ in range(total_partitions)]
+    buffered_bytes = 0
+    partition_sizes = [0] * total_partitions
+
+    for record in records:
+        partition = partitioner(record[0])
+        buffers[partition].append(record)
+        partition_sizes[partition] += 1
+        buffered_bytes += record_size(record)
+
+        if buffered_bytes >= buffer_limit:
+            for i, buffer in enumerate(buffers):
+                if buffer:
+                    runs[i].append(spill_run(buffer, config))
+            buffers = [[] for _ in range(total_partitions)]
+            buffered_bytes = 0
+
+    attempt_outputs = []
+    for i in range(total_partitions):
+        if buffers[i]:
+            runs[i].append(spill_run(buffers[i], config))
+        buffers[i] = None
+        attempt_outputs.append(attempt_file(partition_file(output_prefix, i)))
+        merge_runs(runs[i], attempt_outputs[-1], config)
+
+    for i, attempt_output in enumerate(attempt_outputs):
+        commit_file(attempt_output, partition_file(output_prefix, i))
+
+    return partition_sizes
+
+# Maps the first lines of every split and counts the map output records of every JSON encoded key
+def sample_map_output(files, config):
+    lines_per_split = max(1, config.skew_sample_lines // len(files))
+    counts = collections.Counter()
+    for chunk in files:
+        lines = (line for spec in chunk for line in read_range_lines(*parse_input_range(spec)))
+        lines = list(itertools.islice(lines, lines_per_split))
+        # The sample counts the records of every line, so 'mapper' is used when the module has both
+        if hasattr(config.mr, 'mapper'):
+            records = (record for line in lines for record in config.mr.mapper(line))
+        else:
+            records = batch_records(config.mr.mapper_batch(lines))
+        for record in records:
+            counts[json.dumps(record[0])] += 1
+    return counts
+
+# Cuts the sorted sample into total_partitions ranges with about the same number of records
+def range_boundaries(counts, total_partitions):
+    total = sum(counts.values())
+    boundaries = []
+    seen = 0
+    for key, count in sorted((json.loads(key), count) for key, count in counts.items()):
+        seen += count
+        while len(boundaries) < total_partitions - 1 and seen * total_partitions >= total * (len(boundaries) + 1):
+            boundaries.append(key)
+    return boundaries
+
+# Partial results can only be merged when they can be combined, and the reducer must see them per key. With the schimmy
+# pattern the output of every reducer must stay aligned with its partition for the next iteration
+def salting_supported(config):
+    return hasattr(config.mr, 'combiner') and config.grouped_reducer and not (config.iterations > 1 and uses_schimmy(config))
+
+# Builds the partition plan of the job from a sample of the map output. The plan is empty for plain hash partitioning
+def plan_partitions(files, config):
+    if config.skew_strategy == "none" or config.reducers < 2:
+        return {}
+
+    # Later iterations map the reducer output, which has the same keys, so the sample of the text input is used for all of them
+    if any(spec.startswith(RECORDS_PREFIX) for chunk in files for spec in chunk):
+        return {}
+
+    counts = sample_map_output(files, config)
+    total = sum(counts.values())
+    if total == 0:
+        return {}
+
+    heavy_keys = [key for key, count in counts.most_common() if count * config.reducers > config.skew_threshold * total]
+    print(f"\n\nSampled {total} map output records with {len(counts)} keys")
+    for key in heavy_keys:
+        print(f"Heavy key {key}: {counts[key] / total:.1%} of the sample")
+
+    strategy = config.skew_strategy
+    if strategy == "salt" and not salting_supported(config):
+        print("Salting needs a combiner and a reducer taking (key, values), and cannot be used with the schimmy pattern. Using range partitioning")
+        strategy = "range"
+
+    if strategy == "salt":
+        return {"salted_keys": heavy_keys} if heavy_keys else {}
+    return {"boundaries": range_boundaries(counts, config.reducers)}
+
+def collect_partition_sizes(output_files, total_partitions):
+    sizes = [0] * total_partitions
+    for output_file in output_files:
+        with open(task_stats_file(output_file), 'r') as f:
+            for i, size in enumerate(json.load(f)["partition_records"]):
+                sizes[i] += size
+    return sizes
+
+def print_compression_summary(totals, config):
+    raw_mb = totals["raw_bytes"] / (1024 * 1024)
+    compressed_mb = totals["compressed_bytes"] / (1024 * 1024)
+    ratio = totals["raw_bytes"] / totals["compressed_bytes"] if totals["compressed_bytes"] else 0.0
+    print(f"\n\nCompression ({config.compression}): {raw_mb:.2f} MB written as {compressed_mb:.2f} MB, ratio {ratio:.2f}")
+    print(f"CPU time: {totals['compress_seconds']:.2f}s compressing, {totals['decompress_seconds']:.2f}s decompressing")
+
+def print_partition_histogram(sizes):
+    largest = max(sizes)
+    print("\n\nRecords per reduce partition:")
+    for i, size in enumerate(sizes):
+        bar = "#" * round(40 * size / largest) if largest else ""
+        print(f"{i:>4} {size:>12} {bar}")
+    if largest:
+        print(f"Largest partition: {largest * len(sizes) / sum(sizes):.2f}x the mean")
+
+
+OUTPUT_MODES = ("merged", "partitioned")
+OUTPUT_ORDERS = ("none", "key", "value")
+
+# External sort of all records with the same memory budget as the mappers
+def sort_records(records, config, key, reverse):
+    sorted_file = os.path.join(config.work_folder, get_random_file_name("sorted"))
+    sort_to_file(records, sorted_file, config, key, reverse)
+    return read_records(sorted_file, config)
+
+# The records of the final output, read one at a time from the reducer outputs. Every reducer output is sorted by key
+# when the reducer emits its records in the order of its input keys, so a k-way merge gives globally key-sorted output.
+# Sorting by value puts the highest values first, such as the top ranked pages of PageRank
+def output_records(files, config):
+    inputs = [read_records(file, config) for file in files]
+    if config.output_order == "key":
+        return heapq.merge(*inputs, key=record_key)
+    if config.output_order == "value":
+        if config.output_top_k is not None:
+            return heapq.nlargest(config.output_top_k, itertools.chain(*inputs), key=record_value)
+        return sort_records(itertools.chain(*inputs), config, record_value, True)
+    return itertools.chain(*inputs)
+
+def debug_merge_json_files(files, output_file, config):
     with open(output_file, 'w') as of:
         of.write('[')
         first = True
-        for file in files:
-            with open(file, 'r') as f:
-                data = json.load(f)
-                for item in data:
-                    if not first:
-                        of.write(',')
-                    json.dump(item, of)
-                    first = False
+        for item in output_records(files, config):
+            if not first:
+                of.write(',')
+            json.dump(item, of)
+            first = False
         of.write(']')
 
+# Moves the reducer outputs next to output_file and writes a manifest with their paths, relative to the manifest,
+# and the format they are written in
+def write_partitioned_output(files, output_file, config):
+    partitions = []
+    for i, file in enumerate(files):
+        partition = f"{output_file}.part-{i:05d}"
+        os.replace(file, partition)
+        partitions.append(os.path.basename(partition))
+
+    manifest = {"serializer": config.serializer, "compression": config.compression, "partitions": partitions}
+    with open(output_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
 def debug_merge_files(files, output_file):
     with open(output_file, 'w') as f:
         for file in files:
@@ -205,49 +1706,403 @@ def debug_merge_files(files, output_file):
                 for line in f2:
                     f.write(line)
 
+# Removes the least recently used entries of the map output cache until it fits in map_cache_mb. This runs in the
+# driver between phases. The jobs of a job queue share the cache, but a map task touches an entry before reading it,
+# so the entries in use are the last ones to be evicted
+def evict_map_cache(config):
+    entries = []
+    for filename in os.listdir(config.map_cache_folder):
+        path = os.path.join(config.map_cache_folder, filename)
+        if filename.endswith(".run") and os.path.isfile(path):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    budget = config.map_cache_mb * 1024 * 1024
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total <= budget:
+            break
+        os.remove(path)
+        total -= size
+        evicted += 1
+
+    if evicted:
+        print(f"Map cache: evicted {evicted} entries, {total / (1024 * 1024):.2f} MB left")
+
+# Every job gets its own workspace in tmp_folder for its intermediate files
+def create_workspace(config):
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    config.work_folder = os.path.join(config.tmp_folder, f"job_{timestamp}_{uuid.uuid4().hex[:8]}")
+    os.makedirs(config.work_folder)
+
+# Manifest of a job, kept in its workspace. It has the input splits, the partition plan, the output files of every
+# phase and the node of every committed task, so a job that failed can be resumed with --resume: the phases are run
+# again with the same output files, and the scheduler skips the tasks that were committed before
+class JobManifest:
+    def __init__(self, work_folder, state):
+        self.file = os.path.join(work_folder, MANIFEST_NAME)
+        self.state = state
+        self.lock = threading.RLock()
+
+    # Written to an attempt file first, so a job that dies while saving keeps the previous manifest
+    def save(self):
+        with self.lock:
+            attempt_output = attempt_file(self.file)
+            with open(attempt_output, 'w') as f:
+                json.dump(self.state, f)
+            os.replace(attempt_output, self.file)
+
+    # The output files of a phase are created on its first run and reused when the job is resumed
+    def phase_outputs(self, name, iteration, create):
+        key = f"{iteration}/{name}"
+        with self.lock:
+            if key not in self.state["phases"]:
+                self.state["phases"][key] = create()
+                self.save()
+            return self.state["phases"][key]
+
+    def task_committed(self, output_file, node):
+        with self.lock:
+            self.state["nodes"][output_file] = node
+            self.save()
+
+    def node(self, output_file):
+        return self.state["nodes"].get(output_file)
+
+MANIFEST_NAME = "job.json"
+
+def create_manifest(config, files, plan, plan_inputs):
+    state = {"config_path": os.path.abspath(config.config_path), "created": time.time(), "splits": files, "plan": plan, "plan_inputs": plan_inputs, "phases": {}, "nodes": {}}
+    manifest = JobManifest(config.work_folder, state)
+    manifest.save()
+    return manifest
+
+# The workspace of the last job of this config that did not finish. Workspaces of finished jobs are removed
+def find_unfinished_job(config):
+    config_path = os.path.abspath(config.config_path)
+    for folder in sorted(os.listdir(config.tmp_folder), reverse=True):
+        manifest_file = os.path.join(config.tmp_folder, folder, MANIFEST_NAME)
+        if folder.startswith("job_") and os.path.isfile(manifest_file):
+            with open(manifest_file, 'r') as f:
+                state = json.load(f)
+            if state["config_path"] == config_path:
+                return JobManifest(os.path.join(config.tmp_folder, folder), state)
+    return None
+
+# Removes the workspace of the job. Other jobs running with the same tmp_folder keep their files
 def clean_temporary_files(config):
-    for filename in os.listdir(config.tmp_folder):
-        if filename.startswith("tmp"):
-            file_path = os.path.join(config.tmp_folder, filename)
-            try:
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
-            except Exception as e:
-                print(f"Failed to delete {file_path}: {e}")
-
-def driver(config):
-
-    # List of list of files - each sublist is processed by an individual mapper
-    files = list_and_split_input(config)
-    print("\n\nFiles to process: ", files)
-
-
-    # List of files - each file corresponds to one mapper output
-    map_out = [os.path.join(config.tmp_folder, get_random_file_name("mapper")) for _ in range(config.mappers)]
+    try:
+        shutil.rmtree(config.work_folder)
+    except OSError as e:
+        print(f"Failed to delete {config.work_folder}: {e}")
+
+# Machine readable report of a job, written next to output_file. It has the driver time of every step, and for every
+# phase the stats of each task: node, timestamps, records and bytes in and out, sort and merge time and counters.
+# The overhead of a task is the time between sending it to its node and getting the result back that was not spent
+# running it, such as SSH connection setup and Python startup
+class JobReport:
+    totals = ("records_in", "records_out", "bytes_in", "bytes_out", "sort_seconds", "merge_seconds")
+
+    def __init__(self, config):
+        self.config = config
+        self.start = time.time()
+        self.driver_seconds = collections.defaultdict(float)
+        self.phases = []
+        # Merged cProfile stats of all tasks of every phase, with --profile
+        self.profiles = {}
+
+    def add_driver_time(self, step, start):
+        self.driver_seconds[step] += time.time() - start
+
+    def add_phase(self, name, iteration, scheduler, output_files):
+        tasks = []
+        for index, output_file in enumerate(output_files):
+            with open(task_stats_file(output_file), 'r') as f:
+                stats = json.load(f)
+            # Tasks committed before the job was resumed only have the times they ran on their node
+            recovered = scheduler.timings[index] is None
+            dispatched, returned = (stats["start"], stats["end"]) if recovered else scheduler.timings[index]
+            tasks.append({"task": index, "node": scheduler.nodes[index], "dispatched": dispatched, "returned": returned, "recovered": recovered, **stats})
+
+        phase = {"phase": name, "iteration": iteration, "elapsed": scheduler.elapsed, "speculative_attempts": scheduler.speculative_launched,
+                 "failed_attempts": sum(len(failed) for failed in scheduler.failed_nodes.values())}
+        for total in self.totals:
+            phase[total] = sum(task.get(total, 0) for task in tasks)
+        phase["task_seconds"] = sum(task["end"] - task["start"] for task in tasks)
+        phase["overhead_seconds"] = sum((task["returned"] - task["dispatched"]) - (task["end"] - task["start"]) for task in tasks)
+        phase["tasks"] = tasks
+        cache_results = collections.Counter(task["map_cache"] for task in tasks if "map_cache" in task)
+        if cache_results:
+            phase["map_cache_hits"] = cache_results["hit"]
+            phase["map_cache_misses"] = cache_results["miss"]
+        self.phases.append(phase)
+
+        if self.config.profile:
+            profile_files = [task_profile_file(output_file) for output_file in output_files]
+            if name in self.profiles:
+                self.profiles[name].add(*profile_files)
+            else:
+                self.profiles[name] = pstats.Stats(*profile_files)
+
+        print(f"{name.capitalize()} phase: {phase['records_in']} records in, {phase['records_out']} records out, "
+              f"{phase['bytes_in'] / (1024 * 1024):.2f} MB in, {phase['bytes_out'] / (1024 * 1024):.2f} MB out, "
+              f"{phase['task_seconds']:.2f}s in tasks, {phase['overhead_seconds']:.2f}s task overhead")
+        if cache_results:
+            print(f"Map cache: {cache_results['hit']} hits, {cache_results['miss']} misses")
+
+    # Sums one group of task statistics, such as the counters, over all phases
+    def collect(self, name):
+        totals = collections.Counter()
+        for phase in self.phases:
+            for task in phase["tasks"]:
+                totals.update(task.get(name, {}))
+        return totals
+
+    def write(self, report_file):
+        config = self.config
+        report = {
+            "job": {
+                "mr_def_path": config.mr_def_path,
+                "input_path": config.input_path,
+                "mode": "local" if config.local else "worker" if config.worker_port is not None else "ssh",
+                "mappers": config.mappers,
+                "reducers": config.reducers,
+                "serializer": config.serializer,
+                "compression": config.compression,
+            },
+            "start": self.start,
+            "end": time.time(),
+            "elapsed": time.time() - self.start,
+            "driver_seconds": dict(self.driver_seconds),
+            "shuffle_bytes": sum(phase["bytes_out"] for phase in self.phases if phase["phase"] == "map"),
+            "counters": dict(self.collect("counters")),
+            "phases": self.phases,
+        }
+
+        # One profile per phase, over all iterations. They can be read with pstats or a viewer such as snakeviz
+        if self.profiles:
+            report["profiles"] = {}
+            for name, stats in self.profiles.items():
+                profile_file = f"{os.path.splitext(report_file)[0]}.{name.replace(' ', '_')}.prof"
+                stats.dump_stats(profile_file)
+                report["profiles"][name] = profile_file
+
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    def print_profiles(self, limit=15):
+        for name, stats in self.profiles.items():
+            print(f"\n\nProfile of the {name} phase, over all tasks:")
+            stats.sort_stats(pstats.SortKey.TIME).print_stats(limit)
+
+# Waits until count map tasks are done. A map task writes its stats file after committing all its partitions
+def wait_for_map_tasks(map_out, count, map_thread):
+    while map_thread.is_alive() and sum(os.path.exists(task_stats_file(prefix)) for prefix in map_out) < count:
+        time.sleep(AWAIT_POLL_INTERVAL)
+
+def run_iteration(files, config, plan_inputs, salted, report, iteration, structure_files=None, preferred_nodes=None):
+    # List of output prefixes - each mapper writes one partition file per reducer under its prefix
+    map_out = config.manifest.phase_outputs("map", iteration, lambda: [os.path.join(config.work_folder, get_random_file_name("mapper")) for _ in range(len(files))])
     print(f"\n\nMapper output files: {map_out}")
 
 
-    start_remote_operation(remote_map, files, config, map_out)
+    def run_map_phase():
+        scheduler = start_operation("map", [chunk + plan_inputs for chunk in files], config, map_out)
+        report.add_driver_time("map", scheduler.start_time)
+        report.add_phase("map", iteration, scheduler, map_out)
+        if config.map_cache:
+            evict_map_cache(config)
+        print_partition_histogram(collect_partition_sizes(map_out, config.reducers))
+
+    # In a pipelined job the map phase runs in the background, and reducers are started once reduce_slowstart of the
+    # map tasks are done. If the map phase fails, the abort files stop the reducers that wait for its outputs
+    if config.pipeline:
+        # Left by a failed run of this phase before the job was resumed
+        for prefix in map_out:
+            if os.path.exists(map_abort_file(prefix)):
+                os.remove(map_abort_file(prefix))
+
+        map_errors = []
+        def run_background_map_phase():
+            try:
+                run_map_phase()
+            except BaseException as e:
+                map_errors.append(e)
+                for prefix in map_out:
+                    open(map_abort_file(prefix), 'w').close()
+
+        map_thread = threading.Thread(target=run_background_map_phase)
+        map_thread.start()
+        wait_for_map_tasks(map_out, ceil(config.reduce_slowstart * len(map_out)), map_thread)
+    else:
+        run_map_phase()
 
-    sorted_files = do_sort_before_reduce(map_out, config)
-    print(f"\n\nSorted files: {sorted_files}")
+    # List of list of files - each reducer collects its partition from every mapper
+    if config.pipeline:
+        partitioned_files = [[await_input(prefix, i) for prefix in map_out] + plan_inputs for i in range(config.reducers)]
+    else:
+        partitioned_files = [[partition_file(prefix, i) for prefix in map_out] + plan_inputs for i in range(config.reducers)]
+    if structure_files is not None:
+        for i, structure_file in enumerate(structure_files):
+            partitioned_files[i].append(structure_input(structure_file))
+    print(f"\n\nPartitioned files: {partitioned_files}")
 
 
-    reduce_out = [os.path.join(config.tmp_folder, get_random_file_name("reducer")) for _ in range(config.reducers)]
+    reduce_out = config.manifest.phase_outputs("reduce", iteration, lambda: [os.path.join(config.work_folder, get_random_file_name("reducer")) for _ in range(config.reducers)])
     print(f"\n\nReducer output files: {reduce_out}")
 
-    chunked_sorted_files = split_file_list(sorted_files, config.reducers)
-    print(f"\n\nchunked_sorted_files: {chunked_sorted_files}")
-    
-
-    start_remote_operation(remote_reduce, chunked_sorted_files, config, reduce_out)
 
+    # Reducers are preferably scheduled on the node that wrote their structure partition
+    try:
+        scheduler = start_operation("reduce", partitioned_files, config, reduce_out, preferred_nodes)
+    finally:
+        # A failed map phase is the cause of failed reducers, so its error is the one that is raised
+        if config.pipeline:
+            map_thread.join()
+            if map_errors:
+                raise map_errors[0]
+    report.add_driver_time("reduce", scheduler.start_time)
+    report.add_phase("reduce", iteration, scheduler, reduce_out)
+    reduce_nodes = scheduler.nodes
+
+    # Second stage for salted keys: one reducer merges the partial results that the other reducers combined
+    if salted:
+        merge_out = config.manifest.phase_outputs("salted merge", iteration, lambda: [os.path.join(config.work_folder, get_random_file_name("reducer"))])
+        print(f"\n\nMerging salted keys into: {merge_out}")
+        scheduler = start_operation("reduce", [[salted_partial_file(file) for file in reduce_out]], config, merge_out)
+        report.add_driver_time("reduce", scheduler.start_time)
+        report.add_phase("salted merge", iteration, scheduler, merge_out)
+        reduce_out = reduce_out + merge_out
+
+        # Every heavy key should arrive as partial results from several reducers
+        partials = report.phases[-1]["records_in"]
+        if partials <= len(salted):
+            print(f"Warning: the salted merge got {partials} partial results for {len(salted)} heavy keys, salting did not spread them over the reducers")
+
+    return reduce_out, reduce_nodes
+
+def driver(config, resume=False):
+    report = JobReport(config)
+
+    # A resumed job runs in the workspace of the failed job, with the same splits and partition plan
+    config.manifest = find_unfinished_job(config) if resume else None
+    if config.manifest is not None:
+        config.work_folder = os.path.dirname(config.manifest.file)
+        files = config.manifest.state["splits"]
+        plan = config.manifest.state["plan"]
+        plan_inputs = config.manifest.state["plan_inputs"]
+        print(f"Resuming the job in {config.work_folder}")
+    else:
+        if resume:
+            print("No unfinished job of this config to resume, starting a new one")
+        create_workspace(config)
+        print(f"Workspace: {config.work_folder}")
+
+        # List of list of files - each sublist is processed by an individual mapper
+        start = time.time()
+        files = list_and_split_input(config)
+        report.add_driver_time("split", start)
+        print("\n\nFiles to process: ", files)
+
+        # The partition plan is written to a file that every task gets as an extra input
+        start = time.time()
+        plan = plan_partitions(files, config)
+        plan_inputs = []
+        if plan:
+            plan_file = os.path.join(config.work_folder, get_random_file_name("partitions"))
+            with open(plan_file, 'w') as f:
+                json.dump(plan, f)
+            plan_inputs = [partitions_input(plan_file)]
+        report.add_driver_time("sample", start)
+        config.manifest = create_manifest(config, files, plan, plan_inputs)
+
+    deltas = []
+    structure_files = None
+    reduce_nodes = None
+    for iteration in range(1, config.iterations + 1):
+        if config.iterations > 1:
+            print(f"\n\nIteration {iteration}/{config.iterations}")
+
+        reduce_out, reduce_nodes = run_iteration(files, config, plan_inputs, plan.get("salted_keys", []), report, iteration, structure_files, reduce_nodes)
+
+        counters = collect_counters(reduce_out)
+        if CONVERGENCE_COUNTER in counters:
+            deltas.append(counters[CONVERGENCE_COUNTER])
+            print(f"\n\nIteration {iteration}: delta {deltas[-1]:.6g}")
+            if config.convergence_threshold is not None and deltas[-1] < config.convergence_threshold:
+                print(f"Converged after {iteration} iterations")
+                break
+
+        # The reducer output of this iteration is the map input of the next one
+        files = [[record_input(file) for file in chunk] for chunk in split_file_list(reduce_out, min(number_of_map_tasks(config), len(reduce_out)))]
+        if uses_schimmy(config):
+            structure_files = reduce_out
+
+    start = time.time()
+    shutdown_local_pool(config)
+    report.add_driver_time("shutdown", start)
+
+    if len(deltas) > 1:
+        print("\n\nDelta per iteration: " + ", ".join(f"{delta:.6g}" for delta in deltas))
+
+    if config.compression != 'none':
+        print_compression_summary(report.collect("compression"), config)
+
+    start = time.time()
     output_path = config.output_file if config.output_file != "" else get_random_file_name("final_output")
-    debug_merge_json_files(reduce_out, os.path.join(config.tmp_folder, output_path))
+    if config.output_mode == "partitioned":
+        write_partitioned_output(reduce_out, os.path.join(config.tmp_folder, output_path), config)
+    else:
+        debug_merge_json_files(reduce_out, os.path.join(config.tmp_folder, output_path), config)
+    report.add_driver_time("output", start)
 
+    start = time.time()
     clean_temporary_files(config)
+    report.add_driver_time("cleanup", start)
+
+    report_file = os.path.splitext(os.path.join(config.tmp_folder, output_path))[0] + ".report.json"
+    report.write(report_file)
+    report.print_profiles()
 
     print(f"output: {output_path}")
+    print(f"report: {report_file}")
+
+# Job queue: runs the jobs of several configs in this process, at most max_jobs at the same time, each in its own
+# workspace. Jobs on the same nodes share their slots fairly through the slot allocator, so a short job is not stuck
+# behind the tasks of a long one. The jobs are started in the order they are given
+def run_job_queue(config_paths, max_jobs, profile):
+    global shared_slots
+    configs = [load_config(config_path) for config_path in config_paths]
+    output_files = [config.output_file for config in configs]
+    if len(set(output_files)) < len(output_files):
+        print("Error: the jobs in the queue must have different output files", file=sys.stderr)
+        sys.exit(1)
+
+    shared_slots = SlotAllocator()
+
+    def run_job(config):
+        start = time.time()
+        config.profile = profile
+        try:
+            load_mr_module(config)
+            driver(config)
+            status = "done"
+        # A failed job calls sys.exit or raises, which only ends that job
+        except BaseException as e:
+            if not isinstance(e, SystemExit):
+                traceback.print_exc()
+            status = f"failed ({e!r})"
+        return status, time.time() - start
+
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        results = list(executor.map(run_job, configs))
+
+    print("\n\nJob queue:")
+    for config_path, (status, elapsed) in zip(config_paths, results):
+        print(f"  {config_path}: {status} in {elapsed:.2f}s")
+    if any(status != "done" for status, _ in results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -257,23 +2112,43 @@ if __name__ == "__main__":
         exit(1)
 
     parser = argparse.ArgumentParser(description="Run a MapReduce job.")
-    parser.add_argument("--config_path", type=str, required=True, help="Path to the configuration file.")
-    parser.add_argument("--execution_mode", type=str, choices=["driver", "map", "reduce"], help="Execution mode: 'driver', 'map', or 'reduce'. When starting your job, use the 'driver' option. 'map' and 'reduce' are typically used internally when scheduling these operations on remote nodes.")
+    parser.add_argument("--config_path", type=str, help="Path to the configuration file. Required in every execution mode except 'queue'.")
+    parser.add_argument("--execution_mode", type=str, choices=["driver", "queue", "map", "reduce", "worker", "start_workers", "stop_workers"], help="Execution mode: 'driver', 'queue', 'map', 'reduce', 'worker', 'start_workers' or 'stop_workers'. When starting your job, use the 'driver' option. 'queue' runs the jobs given with --jobs at the same time. 'map' and 'reduce' are typically used internally when scheduling these operations on remote nodes. 'worker' runs a persistent worker daemon, and 'start_workers'/'stop_workers' start or stop one on every node in the config.")
+    parser.add_argument("--jobs", type=str, nargs='+', help="Configuration files of the jobs to run in 'queue' mode.")
+    parser.add_argument("--max_jobs", type=int, default=2, help="Number of jobs that run at the same time in 'queue' mode.")
     parser.add_argument("--intermediate_files", type=str, nargs='?', help="Files to process. Should typically not be specified manually. Use the input_files_folder field in the configuration file instead.")
     parser.add_argument("--tmp_output_file", type=str, nargs='?', help="Path to expected intermediate output file during mapping/redcing.")
+    parser.add_argument("--port", type=int, help="Port of the worker daemon in 'worker' mode. Defaults to worker_port from the configuration file.")
+    parser.add_argument("--bind", type=str, help="Address the worker daemon listens on in 'worker' mode. Defaults to worker_bind from the configuration file.")
+    parser.add_argument("--resume", action="store_true", help="In 'driver' mode, resume the last job of this config that failed. Tasks committed before are not run again.")
+    parser.add_argument("--profile", action="store_true", help="Run every map and reduce task under cProfile. The driver merges the profiles of all tasks of a phase into one file next to output_file.")
 
 
     args = parser.parse_args()
+
+    if args.execution_mode == "queue":
+        if not args.jobs:
+            parser.error("--jobs is required in 'queue' mode")
+        run_job_queue(args.jobs, args.max_jobs, args.profile)
+        sys.exit(0)
+    if args.config_path is None:
+        parser.error("--config_path is required")
+
     config = load_config(args.config_path)
+    config.profile = args.profile
     load_mr_module(config)
 
     print(f"Running {args.execution_mode} on {socket.gethostname()}")
 
     if args.execution_mode == "driver":
-        driver(config)
-    elif args.execution_mode == "map":
-        do_mapping(args.intermediate_files.split(','), config, args.tmp_output_file)
-    elif args.execution_mode == "reduce":
-        do_reducing(args.intermediate_files.split(','), config, args.tmp_output_file)
+        driver(config, args.resume)
+    elif args.execution_mode in ("map", "reduce"):
+        run_task(args.execution_mode, args.intermediate_files.split(','), config, args.tmp_output_file, args.profile)
+    elif args.execution_mode == "worker":
+        run_worker(config, args.port or config.worker_port, args.bind or config.worker_bind)
+    elif args.execution_mode == "start_workers":
+        start_workers(config)
+    elif args.execution_mode == "stop_workers":
+        stop_workers(config)
 
 
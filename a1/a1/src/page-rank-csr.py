@@ -0,0 +1,172 @@
+import argparse
+from array import array
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# Single machine PageRank baseline. The graph is parsed once into a compressed sparse row (CSR) matrix of outgoing links,
+# with every page interned to an integer ID, and every iteration is one vectorised sparse matrix-vector product.
+# It uses the same input format and the same rank formula as page-rank-mapper.py, so the ranks can be compared
+# with the output of a MapReduce job run with the same number of iterations.
+
+DAMPING = 0.85
+INITIAL_RANK = 1.0
+
+
+def load_config(config_path):
+    if not os.path.isfile(config_path):
+        print(f"Config file not found: {config_path}")
+        sys.exit(1)
+
+    with open(config_path, 'r') as f:
+        return json.load(f)
+
+
+# Interns every page to an integer ID in order of first appearance, as a main page or as a link target.
+# Duplicate links are kept, since the mapper also sends a contribution for every occurrence of a link
+def parse_graph(input_path):
+    ids = {}
+    sources = array('q')
+    targets = array('q')
+
+    with open(input_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+
+            pages = line.split(", ")
+            source = ids.setdefault(pages[0], len(ids))
+            for link in pages[1:]:
+                sources.append(source)
+                targets.append(ids.setdefault(link, len(ids)))
+
+    # Sorting the links by source page gives the rows of the CSR matrix
+    sources = np.frombuffer(sources, dtype=np.int64)
+    targets = np.frombuffer(targets, dtype=np.int64)
+    order = np.argsort(sources, kind='stable')
+    indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(ids)), out=indptr[1:])
+
+    names = [None] * len(ids)
+    for name, page_id in ids.items():
+        names[page_id] = name
+
+    return indptr, targets[order], names
+
+
+# The parsed graph is cached as .npy files, keyed by the path, size and modification time of the input
+def load_graph(input_path, cache_folder):
+    stat = os.stat(input_path)
+    key = hashlib.sha256(f"{os.path.abspath(input_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+    cache_path = os.path.join(cache_folder, f"csr_{os.path.basename(input_path)}_{key}")
+
+    if os.path.isdir(cache_path):
+        indptr = np.load(os.path.join(cache_path, "indptr.npy"), mmap_mode='r')
+        indices = np.load(os.path.join(cache_path, "indices.npy"), mmap_mode='r')
+        with open(os.path.join(cache_path, "pages.json"), 'r') as f:
+            names = json.load(f)
+        return indptr, indices, names, True
+
+    indptr, indices, names = parse_graph(input_path)
+
+    # Written to a temporary folder first, so an interrupted run never leaves a partial cache behind
+    tmp_path = f"{cache_path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, "indptr.npy"), indptr)
+    np.save(os.path.join(tmp_path, "indices.npy"), indices)
+    with open(os.path.join(tmp_path, "pages.json"), 'w') as f:
+        json.dump(names, f)
+    os.replace(tmp_path, cache_path)
+
+    return indptr, indices, names, False
+
+
+# One iteration: every page sends rank / out-degree along each outgoing link, which is the product of the transposed
+# CSR matrix with the rank vector. The MapReduce job drops the rank of pages without outgoing links. With
+# dangling="redistribute" it is spread evenly over all pages instead
+def page_rank(indptr, indices, iterations, threshold, damping, dangling):
+    n_pages = len(indptr) - 1
+    out_degree = np.diff(indptr)
+    has_links = out_degree > 0
+    inverse_degree = np.zeros(n_pages)
+    inverse_degree[has_links] = 1.0 / out_degree[has_links]
+
+    rank = np.full(n_pages, INITIAL_RANK)
+    deltas = []
+    for iteration in range(1, iterations + 1):
+        weights = np.repeat(rank * inverse_degree, out_degree)
+        incoming = np.bincount(indices, weights=weights, minlength=n_pages)
+
+        if dangling == "redistribute":
+            incoming += rank[~has_links].sum() / n_pages
+
+        new_rank = (1 - damping) + damping * incoming
+        deltas.append(float(np.abs(new_rank - rank).sum()))
+        rank = new_rank
+        print(f"Iteration {iteration}: delta {deltas[-1]:.6g}")
+
+        if threshold is not None and deltas[-1] < threshold:
+            print(f"Converged after {iteration} iterations")
+            break
+
+    return rank, deltas
+
+
+# Same format as the output of the MapReduce job: [page, rank, outgoing links]
+def write_output(output_file, names, rank, indptr, indices):
+    with open(output_file, 'w') as f:
+        f.write('[')
+        for page_id, name in enumerate(names):
+            if page_id:
+                f.write(',')
+            links = [names[link] for link in indices[indptr[page_id]:indptr[page_id + 1]]]
+            json.dump([name, float(rank[page_id]), links], f)
+        f.write(']')
+
+
+def compare_output(compare_file, names, rank):
+    with open(compare_file, 'r') as f:
+        other = {record[0]: record[1] for record in json.load(f)}
+
+    missing = [name for name in names if name not in other]
+    common = [page_id for page_id, name in enumerate(names) if name in other]
+    difference = np.abs(rank[common] - np.array([other[names[page_id]] for page_id in common])) if common else np.zeros(1)
+    print(f"Compared with {compare_file}: {len(common)} pages in both, {len(missing)} missing, {len(other) - len(common)} extra")
+    print(f"Max rank difference: {difference.max():.3g}, L1 difference: {difference.sum():.3g}")
+
+
+if __name__ == "__main__":
+    current_folder = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description="Compute PageRank on a single machine with a CSR graph.")
+    parser.add_argument("--config_path", type=str, required=True, help="Path to the configuration file. input_path, tmp_folder, output_file, iterations and convergence_threshold are used.")
+    parser.add_argument("--output_file", type=str, help="Where to write the ranks. Defaults to output_file from the configuration file with a .csr suffix.")
+    parser.add_argument("--dangling", type=str, choices=["drop", "redistribute"], default="drop", help="What happens to the rank of pages without outgoing links. 'drop' gives the same ranks as the MapReduce job.")
+    parser.add_argument("--compare", type=str, help="Output file of a MapReduce job to compare the ranks with.")
+
+    args = parser.parse_args()
+    config = load_config(args.config_path)
+
+    input_path = os.path.join(current_folder, config.get('input_path'))
+    tmp_folder = os.path.join(current_folder, config.get('tmp_folder'))
+    output_file = args.output_file or os.path.join(current_folder, config.get('output_file')) + ".csr"
+    os.makedirs(tmp_folder, exist_ok=True)
+
+    start = time.time()
+    indptr, indices, names, cached = load_graph(input_path, tmp_folder)
+    print(f"{'Loaded cached' if cached else 'Parsed'} graph with {len(names)} pages and {len(indices)} links in {time.time() - start:.2f}s")
+
+    start = time.time()
+    rank, deltas = page_rank(indptr, indices, config.get('iterations', 1), config.get('convergence_threshold'), DAMPING, args.dangling)
+    print(f"{len(deltas)} iterations in {time.time() - start:.2f}s")
+
+    write_output(output_file, names, rank, indptr, indices)
+    print(f"output: {output_file}")
+
+    if args.compare:
+        compare_output(args.compare, names, rank)
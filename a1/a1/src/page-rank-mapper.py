@@ -1,4 +1,26 @@
 import sys
+
+DAMPING = 0.85      # probability of following a link instead of jumping to a random page
+INITIAL_RANK = 1.0  # innitially PR=1.0
+
+# increment_counter(name, amount) is provided by mapreduce.py when it loads this module.
+# The fallback keeps the module usable on its own, for example when it is imported by a test
+if "increment_counter" not in globals():
+    def increment_counter(name, amount=1):
+        pass
+
+
+# The PageRank contributions a page sends along its outgoing links
+def contributions(rank, outgoing_links):
+    # If there are outgoing links, distribute PR
+    num_links = len(outgoing_links)
+    if num_links == 0:
+        return []
+
+    contribution = rank / num_links
+    return [(link, contribution) for link in outgoing_links]
+
+
 # The 'map' function which will be executed in parallel.
 # The input is a string of words separated by spaces.
 # For word count, the output is a list of three variables where the first element is the page, the second element is the page's rank OR the list of outgoing links
@@ -9,69 +31,81 @@ def mapper(data):
     # Iterate through each line of the data (one line is one page and its utgoing links)
     for line in data.strip().split("\n"):
 
-        # Skip emty lines 
+        # Skip emty lines
         if not line:
             continue
 
-        pages = line.split(", ")        
+        pages = line.split(", ")
         mainpage = pages[0]             # First item is the mainpage
         outgoing_links = pages[1:] if len(pages) > 1 else []  # List of outgoing pages
 
-        rank = 1.0  #innitially PR=1.0
-        num_links = len(outgoing_links)
-
-        # append the links
-        output.append((mainpage, f"links:{','.join(outgoing_links)}"))
-        
-        # If there are outgoing links, distribute PR 
-        if num_links > 0:
-            contribution = rank / num_links
-            for link in outgoing_links:
-                output.append((link, contribution)) 
-
+        # The structure value is a list [outgoing links, current rank], so the reducer can preserve the graph and see how much the rank changed
+        output.append((mainpage, [outgoing_links, INITIAL_RANK]))
+        output.extend(contributions(INITIAL_RANK, outgoing_links))
 
     return output  # Return a list of (key, value) pairs where the value can be a rank or a list
 
 
+# The 'map' function for a block of input lines, used instead of 'mapper' when it exists.
+# 'mapper' already takes several lines, so the whole block is mapped in one call instead of one call per line
+def mapper_batch(lines):
+    return mapper("\n".join(lines))
 
 
-# The 'reduce' function which will be executed in parallel.
-# The input is a list of tuples where the first element is a page and the second element is the rank OR the number of links.
-# the input might consists of multiple page ranks for the same page, its the reducers job to reduce :))))
-# The output is a list of tuples where the first element is a page and the second element is the page's new rank.
-# the output only has unique pages 
+# The 'map' function of the following iterations of an iterative job.
+# The input is one output record of the reducer from the previous iteration, so the links are already parsed.
+# Only the contributions are emitted: the structure entry of the page is added by the framework with 'structure',
+# either through the shuffle or read by the reducer directly from its previous output (the schimmy pattern)
+def iteration_mapper(record):
+    page, rank, outgoing_links = record
+    return contributions(rank, outgoing_links)
 
-# TODO: må ta vare på links her også?? 
 
-def reducer(data):
-    pages = {}      # store PageRank values 
-    links = {}      # store graph structures (outgoing links)
+# The structure entry of a page, in the same format as the one emitted by 'mapper'
+def structure(record):
+    page, rank, outgoing_links = record
+    return (page, [outgoing_links, rank])
 
-    for entry in data:
-        page, rank = entry
 
-        # If the value starts with "links:", it's a structure preservation entry
-        if isinstance(rank, str) and rank.startswith("links:"):
-            links[page] = rank
-        else:  # Otherwise, it's a PageRank contribution
-            if page in pages:
-                pages[page] += rank
-            else:
-                pages[page] = rank
 
+# The 'combine' function which runs inside each mapper on a buffer of its output.
+# It sums the PageRank contributions sent to the same page, so only one contribution per target page is written to disk.
+# The structure entries are passed through unchanged, since the reducer needs them to preserve the graph structure
+def combiner(data):
+    summed = {}
     output = []
 
-    # Make sure all nodes appear in the final output 
-    all_nodes = set(pages.keys()).union(set(links.keys()))      # The union of all known nodes 
-    
-    # add a list of (key, value) pairs to the output list 
-    for page in all_nodes:
-        # Set the default value to 0.0 if there is no contribution 
-        pr_value = pages.get(page, 0.0)
-        # If there are any links left, include them, if nor, return the pagerank 
-        if page in links:
-            output.append([page, pr_value, links[page]]) 
+    for page, rank in data:
+        if isinstance(rank, list):
+            output.append((page, rank))
         else:
-            output.append([page, pr_value]) 
-    
-    return output
\ No newline at end of file
+            summed[page] = summed.get(page, 0.0) + rank
+
+    output.extend(summed.items())
+    return output
+
+
+
+# The 'reduce' function which will be executed in parallel.
+# It is called once for every page, with the page and an iterator over the values emitted for it: the rank contributions OR the structure entry.
+# The output is a list with a single tuple [page, new rank, outgoing links], which is also the input of 'iteration_mapper'.
+# the output only has unique pages, since every page is reduced exactly once
+
+def reducer(page, values):
+    contributions = 0.0     # sum of the PageRank contributions
+    outgoing_links = []     # graph structure (outgoing links)
+    previous_rank = INITIAL_RANK  # pages that only appear as link targets have no structure entry
+
+    for value in values:
+        # If the value is a list, it's a structure preservation entry
+        if isinstance(value, list):
+            outgoing_links, previous_rank = value
+        else:  # Otherwise, it's a PageRank contribution
+            contributions += value
+
+    rank = (1 - DAMPING) + DAMPING * contributions
+
+    # The L1 change of the ranks, used by the driver to detect convergence
+    increment_counter("convergence_delta", abs(rank - previous_rank))
+
+    return [[page, rank, outgoing_links]]
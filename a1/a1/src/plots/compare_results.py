@@ -2,25 +2,28 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-# Load the data
+# Load the averages written by tests/avrage.py
 file_path = "averaged_execution_time.txt"
 df = pd.read_csv(file_path, delimiter="\t")
 
-# Generate heatmaps for each dataset
+# Generate heatmaps for each dataset (columns) and execution mode (rows)
 datasets = df["Dataset"].unique()
+modes = df["Mode"].unique()
 
 # Set up the figure
-fig, axes = plt.subplots(1, len(datasets), figsize=(20, 6))
-fig.suptitle("Execution Time Heatmap: Mappers vs. Reducers")
-vmin, vmax = df["Execution Time"].min(), df["Execution Time"].max()
+fig, axes = plt.subplots(len(modes), len(datasets), figsize=(5 * len(datasets), 5 * len(modes)), squeeze=False)
+fig.suptitle("Throughput (MB/s) Heatmap: Mappers vs. Reducers")
+vmin, vmax = df["Throughput MB/s"].min(), df["Throughput MB/s"].max()
 
 
-for ax, dataset in zip(axes, datasets):
-    subset = df[df["Dataset"] == dataset].pivot(index="Mappers", columns="Reducers", values="Execution Time")
-    sns.heatmap(subset, annot=False, cmap="viridis", linewidths=0.5, ax=ax, vmin=vmin, vmax=vmax)
-    ax.set_title(dataset)
-    ax.set_xlabel("Reducers")
-    ax.set_ylabel("Mappers")
+for row, mode in enumerate(modes):
+    for column, dataset in enumerate(datasets):
+        ax = axes[row][column]
+        subset = df[(df["Dataset"] == dataset) & (df["Mode"] == mode)].pivot(index="Mappers", columns="Reducers", values="Throughput MB/s")
+        sns.heatmap(subset, annot=False, cmap="viridis", linewidths=0.5, ax=ax, vmin=vmin, vmax=vmax)
+        ax.set_title(f"{dataset} ({mode})")
+        ax.set_xlabel("Reducers")
+        ax.set_ylabel("Mappers")
 
 
 # Save the plot
@@ -1,20 +1,23 @@
 import pandas as pd
 
-# Load data
-file_path = "pagerank_benchmark.log"  # Change this if needed
+# Load the results of test.py, one row per run
+file_path = "benchmark_results.csv"  # Change this if needed
 df = pd.read_csv(file_path)
 
-# Calculate the average execution time for each (Dataset, Mappers, Reducers) combination
-avg_execution_time = df.groupby(["Dataset", "Mappers", "Reducers"])['Execution Time'].mean().reset_index()
+# Runs with wrong output are not timed results
+wrong = df[~df["Correct"]]
+if len(wrong):
+    print(f"Skipping {len(wrong)} runs with wrong output")
+df = df[df["Correct"]]
 
-# Define custom sorting order for datasets
-custom_order = ["data-pr/input-mini.txt", "data-pr/input-small.txt", "data-pr/input-large.txt"]
-avg_execution_time["Dataset"] = pd.Categorical(avg_execution_time["Dataset"], categories=custom_order, ordered=True)
+# Calculate the average of every measurement for each (Dataset, Mode, Mappers, Reducers) combination
+measurements = ["Execution Time", "Throughput MB/s", "Peak Memory MB", "Map Seconds", "Reduce Seconds", "Task Overhead"]
+averages = df.groupby(["Dataset", "Job", "Mode", "Mappers", "Reducers"])[measurements].mean().reset_index()
 
-# Sort by custom order
-avg_execution_time = avg_execution_time.sort_values(by=["Dataset"])
+# Sort by dataset, then by mode and task counts
+averages = averages.sort_values(by=["Dataset", "Mode", "Mappers", "Reducers"])
 
 # Save to file
-avg_execution_time.to_csv("averaged_execution_time.txt", index=False, sep='\t')
+averages.to_csv("averaged_execution_time.txt", index=False, sep='\t')
 
-print("Averaged execution times per (Dataset, Mappers, Reducers) combination have been computed, sorted (mini -> small -> large), and saved.")
+print("Averaged measurements per (Dataset, Mode, Mappers, Reducers) combination have been computed, sorted and saved.")
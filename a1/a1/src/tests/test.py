@@ -1,92 +1,341 @@
-import subprocess
-import os
+import argparse
+import collections
+import importlib.util
+import itertools
 import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
 import time
-import random  # Import random module
+
+# Benchmark suite for mapreduce.py that runs on one machine. It generates synthetic inputs of a controlled size and skew,
+# runs every job with temporary configs for each combination of execution mode, mappers and reducers, checks the output
+# against a reference computed in this process, and writes one CSV row per run. avrage.py averages the rows, and the
+# scripts in plots/ draw them. With --baseline, the averages are compared with a saved run and regressions are flagged
 
 current_folder = os.path.dirname(os.path.abspath(__file__))
-# config_path = os.path.join(current_folder, "word-count-config.json")
-config_path = os.path.join(current_folder, "page-rank-config.json")
-output_log = os.path.join(current_folder, "pagerank_benchmark.log")
+src_folder = os.path.dirname(current_folder)
+mapreduce_path = os.path.join(src_folder, "mapreduce.py")
+
+COLUMNS = ["Dataset", "Job", "Mode", "Mappers", "Reducers", "Run", "Execution Time", "Input MB", "Throughput MB/s",
+           "Peak Memory MB", "Map Seconds", "Reduce Seconds", "Task Overhead", "Correct"]
+
+# Datasets of every suite: (name, job, generator arguments). Sizes are multiplied by --scale
+SUITES = {
+    "quick": [
+        ("text-uniform", "wc", {"lines": 20000, "skew": 0.0}),
+        ("text-zipf", "wc", {"lines": 20000, "skew": 1.2}),
+        ("graph-uniform", "pr", {"pages": 5000, "skew": 0.0}),
+        ("graph-zipf", "pr", {"pages": 5000, "skew": 1.2}),
+    ],
+    "full": [
+        ("text-uniform", "wc", {"lines": 200000, "skew": 0.0}),
+        ("text-zipf", "wc", {"lines": 200000, "skew": 1.2}),
+        ("text-hot", "wc", {"lines": 200000, "skew": 2.0}),
+        ("graph-uniform", "pr", {"pages": 50000, "skew": 0.0}),
+        ("graph-zipf", "pr", {"pages": 50000, "skew": 1.2}),
+        ("graph-hot", "pr", {"pages": 50000, "skew": 2.0}),
+    ],
+}
+
+MR_MODULES = {"wc": "word-count-mapper.py", "pr": "page-rank-mapper.py"}
+
+
+# Weights of a Zipf distribution over n items. skew 0 is uniform, higher values concentrate on the first items
+def zipf_weights(n, skew):
+    return list(itertools.accumulate(1.0 / (rank + 1) ** skew for rank in range(n)))
+
+def generate_text(path, rng, lines, skew, words_per_line=10, vocabulary=5000):
+    words = [f"word{i}" for i in range(vocabulary)]
+    weights = zipf_weights(vocabulary, skew)
+    with open(path, 'w') as f:
+        for _ in range(lines):
+            f.write(" ".join(rng.choices(words, cum_weights=weights, k=words_per_line)) + "\n")
+
+# Every page links to a random number of pages. With skew, a few pages get most of the incoming links
+def generate_graph(path, rng, pages, skew, max_links=8):
+    names = [f"P{i}" for i in range(pages)]
+    weights = zipf_weights(pages, skew)
+    with open(path, 'w') as f:
+        for name in names:
+            links = rng.choices(names, cum_weights=weights, k=rng.randint(0, max_links))
+            f.write(", ".join([name] + links) + "\n")
+
+def generate_datasets(suite, scale, data_folder, seed):
+    datasets = []
+    for name, job, arguments in SUITES[suite]:
+        path = os.path.join(data_folder, f"{name}.txt")
+        rng = random.Random(f"{seed}-{name}")
+        if job == "wc":
+            generate_text(path, rng, int(arguments["lines"] * scale), arguments["skew"])
+        else:
+            generate_graph(path, rng, int(arguments["pages"] * scale), arguments["skew"])
+        datasets.append((name, job, path))
+    return datasets
+
+
+def load_module(job):
+    spec = importlib.util.spec_from_file_location(f"reference_{job}", os.path.join(src_folder, MR_MODULES[job]))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Runs the MR module in this process, one line and one key at a time, to get the expected output
+def reference_output(job, path, iterations):
+    module = load_module(job)
+    with open(path, 'r') as f:
+        records = [record for line in f for record in module.mapper(line)]
+
+    for iteration in range(iterations):
+        if iteration:
+            records = [record for output in outputs for record in module.iteration_mapper(output)]
+            if hasattr(module, 'structure'):
+                records += [module.structure(output) for output in outputs]
+        records.sort(key=lambda record: record[0])
+        outputs = [output for key, group in itertools.groupby(records, key=lambda record: record[0])
+                   for output in module.reducer(key, (record[1] for record in group))]
+    return {output[0]: output[1:] for output in outputs}
+
+def check_output(output_file, reference):
+    with open(output_file, 'r') as f:
+        output = {record[0]: record[1:] for record in json.load(f)}
+    if output.keys() != reference.keys():
+        return False
+    for key, expected in reference.items():
+        value = output[key]
+        if isinstance(expected[0], float):
+            if abs(value[0] - expected[0]) > 1e-6 or value[1:] != expected[1:]:
+                return False
+        elif value != expected:
+            return False
+    return True
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('', 0))
+        return sock.getsockname()[1]
+
+def write_config(config_path, job, input_path, work_folder, mappers, reducers, mode, options):
+    config = {
+        "mr_def_path": os.path.join(src_folder, MR_MODULES[job]),
+        "input_path": input_path,
+        "tmp_folder": os.path.join(work_folder, "mr_tmp"),
+        "output_file": os.path.join(work_folder, "mr_tmp", "output.txt"),
+        "mappers": mappers,
+        "reducers": reducers,
+        "nodes": options["nodes"],
+        "local": mode == "local",
+        "input_scale": 1,
+        "iterations": options["iterations"] if job == "pr" else 1,
+    }
+    if mode == "worker":
+        config["worker_port"] = options["worker_port"]
+        # Outside tmp_folder, which is removed before every run while the worker keeps running
+        config["worker_token_file"] = os.path.join(work_folder, "worker.token")
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=2)
+    return config
+
+# Runs the driver and returns its exit code, wall clock time and peak memory. The peak memory is the largest resident
+# set of the driver and the task processes it started and waited for, which includes the local worker pool
+def run_driver(config_path, log_path):
+    with open(log_path, 'w') as log:
+        start = time.time()
+        process = subprocess.Popen([sys.executable, mapreduce_path, "--config_path", config_path, "--execution_mode", "driver"],
+                                   cwd=src_folder, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.time() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, elapsed, usage.ru_maxrss / 1024
+
+# In worker mode the tasks run in the worker daemon and its pool processes, which wait4 does not see. Their peak resident
+# sets are read from VmHWM in /proc, after resetting them before every run by writing 5 to clear_refs. Without /proc,
+# the peak memory of worker runs is left empty
+def worker_processes(pid):
+    pids = [pid]
+    for parent in pids:
+        try:
+            for task in os.listdir(f"/proc/{parent}/task"):
+                with open(f"/proc/{parent}/task/{task}/children", 'r') as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            # The process exited, or there is no /proc
+            pass
+    return pids
 
-# Function to get available nodes from the cluster
-def get_available_nodes():
+def reset_worker_peak(worker):
+    for pid in worker_processes(worker.pid):
+        try:
+            with open(f"/proc/{pid}/clear_refs", 'w') as f:
+                f.write("5")
+        except OSError:
+            pass
+
+def worker_peak_mb(worker):
+    peaks = []
+    for pid in worker_processes(worker.pid):
+        try:
+            with open(f"/proc/{pid}/status", 'r') as f:
+                peaks.extend(int(line.split()[1]) / 1024 for line in f if line.startswith("VmHWM:"))
+        except OSError:
+            pass
+    return max(peaks) if peaks else None
+
+def phase_seconds(report, name):
+    return sum(phase["elapsed"] for phase in report["phases"] if phase["phase"] == name)
+
+# A worker daemon on this machine for the 'worker' mode, started with the config that the runs rewrite in place
+def start_worker(config_path, port, log_path):
+    worker = subprocess.Popen([sys.executable, mapreduce_path, "--config_path", config_path, "--execution_mode", "worker", "--port", str(port)],
+                              cwd=src_folder, stdout=open(log_path, 'w'), stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return worker
+        except OSError:
+            time.sleep(0.2)
+    worker.kill()
+    raise RuntimeError(f"Worker did not start, see {log_path}")
+
+# The shutdown request also stops the process pool of the worker, which a signal would leave running
+def stop_worker(worker, port, token_file):
+    with open(token_file, 'r') as f:
+        token = f.read().strip()
+    with socket.create_connection(("localhost", port)) as sock:
+        sock.sendall((json.dumps({"mode": "shutdown", "token": token}) + "\n").encode())
+        sock.recv(1024)
+    worker.wait()
+
+
+def run_benchmark(args, datasets, work_folder, results_file):
+    options = {"nodes": args.nodes or ["localhost"], "iterations": args.iterations, "worker_port": free_port()}
+    config_path = os.path.join(work_folder, "benchmark-config.json")
+    log_path = os.path.join(work_folder, "driver.log")
+    rows = []
+
+    with open(results_file, 'w') as results:
+        results.write(",".join(COLUMNS) + "\n")
+
+        for name, job, input_path in datasets:
+            reference = reference_output(job, input_path, options["iterations"] if job == "pr" else 1)
+            input_mb = os.path.getsize(input_path) / (1024 * 1024)
+
+            for mode in args.modes:
+                worker = None
+                for mappers, reducers in itertools.product(args.mappers, args.reducers):
+                    config = write_config(config_path, job, input_path, work_folder, mappers, reducers, mode, options)
+                    if mode == "worker" and worker is None:
+                        worker = start_worker(config_path, options["worker_port"], os.path.join(work_folder, "worker.log"))
+
+                    for run in range(1, args.runs + 1):
+                        shutil.rmtree(config["tmp_folder"], ignore_errors=True)
+                        if worker is not None:
+                            reset_worker_peak(worker)
+                        exit_code, elapsed, peak_mb = run_driver(config_path, log_path)
+                        # The largest resident set of a single process, the driver or one of the worker processes
+                        if worker is not None:
+                            worker_mb = worker_peak_mb(worker)
+                            peak_mb = max(peak_mb, worker_mb) if worker_mb is not None else None
+
+                        correct = False
+                        report = {"phases": []}
+                        if exit_code == 0:
+                            correct = check_output(config["output_file"], reference)
+                            with open(os.path.splitext(config["output_file"])[0] + ".report.json", 'r') as f:
+                                report = json.load(f)
+                        else:
+                            with open(log_path, 'r') as f:
+                                print(f.read()[-2000:])
+
+                        row = [name, job, mode, mappers, reducers, run, round(elapsed, 4), round(input_mb, 3),
+                               round(input_mb / elapsed, 3), "" if peak_mb is None else round(peak_mb, 1), round(phase_seconds(report, "map"), 4),
+                               round(phase_seconds(report, "reduce"), 4),
+                               round(sum(phase["overhead_seconds"] for phase in report["phases"]), 4), correct]
+                        rows.append(dict(zip(COLUMNS, row)))
+                        results.write(",".join(str(value) for value in row) + "\n")
+                        results.flush()
+                        print(f"{name} {mode} mappers={mappers} reducers={reducers} run {run}: {elapsed:.3f}s, "
+                              f"{input_mb / elapsed:.2f} MB/s, peak {'n/a' if peak_mb is None else f'{peak_mb:.0f} MB'}, {'correct' if correct else 'WRONG OUTPUT'}")
+
+                if worker is not None:
+                    stop_worker(worker, options["worker_port"], config["worker_token_file"])
+    return rows
+
+
+# Median time and throughput and maximum peak memory of every configuration. The peak memory is None when it was not measured
+def summarize(rows):
+    groups = collections.defaultdict(list)
+    for row in rows:
+        groups["|".join(str(row[column]) for column in ("Dataset", "Mode", "Mappers", "Reducers"))].append(row)
+    return {key: {"seconds": statistics.median(row["Execution Time"] for row in group),
+                  "throughput": statistics.median(row["Throughput MB/s"] for row in group),
+                  "peak_mb": max((row["Peak Memory MB"] for row in group if row["Peak Memory MB"] != ""), default=None)}
+            for key, group in groups.items()}
+
+# A configuration regressed when it is slower or uses more memory than the baseline by more than the tolerance.
+# Differences below min_seconds are ignored, since short runs are dominated by noise
+def compare_with_baseline(summary, baseline, tolerance, min_seconds=0.05):
+    regressions = []
+    for key, current in sorted(summary.items()):
+        if key not in baseline:
+            continue
+        previous = baseline[key]
+        if current["seconds"] > previous["seconds"] * (1 + tolerance) and current["seconds"] - previous["seconds"] > min_seconds:
+            regressions.append(f"{key}: {previous['seconds']:.3f}s -> {current['seconds']:.3f}s")
+        if current["peak_mb"] is not None and previous["peak_mb"] is not None and current["peak_mb"] > previous["peak_mb"] * (1 + tolerance):
+            regressions.append(f"{key}: peak memory {previous['peak_mb']:.0f} MB -> {current['peak_mb']:.0f} MB")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark mapreduce.py on synthetic inputs on this machine.")
+    parser.add_argument("--suite", choices=sorted(SUITES), default="quick", help="Set of datasets to generate.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplies the size of every dataset.")
+    parser.add_argument("--modes", type=lambda value: value.split(","), default=["local", "worker"], help="Comma separated execution modes: local, worker and ssh. ssh needs fabric and SSH access to --nodes.")
+    parser.add_argument("--nodes", type=lambda value: value.split(","), help="Comma separated nodes for the ssh mode. Defaults to localhost.")
+    parser.add_argument("--mappers", type=lambda value: [int(n) for n in value.split(",")], default=[2, 4, 8])
+    parser.add_argument("--reducers", type=lambda value: [int(n) for n in value.split(",")], default=[2, 4, 8])
+    parser.add_argument("--runs", type=int, default=3, help="Runs of every configuration.")
+    parser.add_argument("--iterations", type=int, default=1, help="Iterations of the PageRank jobs.")
+    parser.add_argument("--seed", type=int, default=3203, help="Seed of the input generators, the same seed gives the same inputs.")
+    parser.add_argument("--output", default=os.path.join(current_folder, "benchmark_results.csv"), help="CSV file with one row per run.")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare with. Regressions make the script exit with an error.")
+    parser.add_argument("--save_baseline", help="Write the results of this run to this JSON file, to be used as a baseline later.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown compared with the baseline, as a fraction.")
+    args = parser.parse_args()
+
+    work_folder = tempfile.mkdtemp(prefix="mapreduce-benchmark-")
     try:
-        # Run the command to list available nodes
-        result = subprocess.run(["/share/ifi/available-nodes.sh"], capture_output=True, text=True, check=True)
-        
-        # Split output into a list of nodes
-        nodes = result.stdout.strip().split("\n")
-        
-        # Return the list of available nodes
-        return nodes if nodes else []
-    except subprocess.CalledProcessError as e:
-        print("Error retrieving available nodes:", e)
-        return []
-
-# Fetch available nodes from cluster 
-available_nodes = get_available_nodes()
-
-# Datasets to test
-datasets = [
-    #"data-wc/word-count-sanity-check.txt"
-    "data-pr/input-large.txt",
-    "data-pr/input-small.txt",
-    "data-pr/input-mini.txt"
-]
-
-# Different configurations of mappers and reducers
-mapper_counts = [2, 4, 8, 16]
-reducer_counts = [2, 4, 8, 16]
-runs_per_config = 20
-
-# Running the tests with different combinations
-with open(output_log, "w") as log_file:
-    log_file.write("Dataset,Mappers,Reducers,Run,Execution Time\n")
-
-    for dataset in datasets:
-        for mappers in mapper_counts:
-            for reducers in reducer_counts:
-                for run in range(1, runs_per_config + 1):
-                    # Modify config file
-                    with open(config_path, "r") as f:
-                        config_data = json.load(f)
-
-                    # Select a random subset of available nodes
-                    num_nodes = min(max(mappers, reducers), len(available_nodes))
-                    selected_nodes = random.sample(available_nodes, num_nodes)
-
-                    # Update the input dataset, mappers/reducers, and node selection
-                    config_data["input_path"] = dataset
-                    config_data["mappers"] = mappers
-                    config_data["reducers"] = reducers
-                    config_data["nodes"] = selected_nodes  # Assign random nodes
-
-                    # Save the modified config file
-                    with open(config_path, "w") as f:
-                        json.dump(config_data, f, indent=4)
-
-                    print(f"\nRunning test {run}/{runs_per_config} with {mappers} mappers and {reducers} reducers on {dataset} using nodes {selected_nodes}...")
-
-                    # Define the command
-                    command = [
-                        "python3",
-                        "mapreduce.py",
-                        "--config_path",
-                        config_path,
-                        "--execution_mode",
-                         "distributed"
-                    ]
-
-                    # Start the timer
-                    start_time = time.time()
-                    result = subprocess.run(command, capture_output=True, text=True)
-                    
-                    # Stop the timer
-                    end_time = time.time()
-                    elapsed_time = end_time - start_time  # Compute elapsed time
-
-                    print(f"Execution Time: {elapsed_time:.4f} seconds")
-                    log_file.write(f"{dataset},{mappers},{reducers},{run},{elapsed_time:.4f}\n")
-
-print("\ndone, wrote to log file")
+        data_folder = os.path.join(work_folder, "data")
+        os.makedirs(data_folder)
+        datasets = generate_datasets(args.suite, args.scale, data_folder, args.seed)
+        rows = run_benchmark(args, datasets, work_folder, args.output)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    summary = summarize(rows)
+    failures = [row for row in rows if not row["Correct"]]
+    print(f"\n{len(rows)} runs written to {args.output}, {len(failures)} with wrong output")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare_with_baseline(summary, json.load(f), args.tolerance)
+        print(f"{len(regressions)} regressions compared with {args.baseline}")
+        for regression in regressions:
+            print(f"  REGRESSION {regression}")
+
+    if failures or regressions:
+        sys.exit(1)
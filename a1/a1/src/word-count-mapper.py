@@ -1,3 +1,5 @@
+from collections import Counter
+
 # The 'map' function which will be executed in parallel.
 # The input is a string of words separated by spaces.
 # For word count, the output is a list of tuples where the first element is a word and the second element is the number 1.
@@ -7,21 +9,33 @@ def mapper(data):
     mapped_data = [(word, 1) for word in data.split()]
     return mapped_data
 
+# The 'mapper_batch' function is optional, and is used instead of 'mapper' when it exists.
+# The input is a list of thousands of lines of the input, and the output is either a list of tuples like the mapper output,
+# or the keys and values as two columns, {"keys": [...], "values": [...]}, which can also be NumPy arrays.
+# For word count, the words of the whole block are split at once and counted, so one tuple per distinct word is emitted.
+# This is safe since the reducer sums the counts
+def mapper_batch(lines):
+    words = Counter(" ".join(lines).split())
+    return {"keys": list(words.keys()), "values": list(words.values())}
+
+# The 'combine' function is optional and runs inside each mapper on a buffer of its output.
+# The input is a list of tuples like the mapper output, and the output is a list of tuples in the same format.
+# For word count, it sums the counts of each word in the buffer, so the mapper writes one tuple per distinct word instead of one per token.
+# Note that the reducer will receive the combined tuples, so the combine logic has to be safe to apply to any subset of the mapper output
+def combiner(data):
+    words = {}
+    for word, count in data:
+        words[word] = words.get(word, 0) + count
+    return [(word, count) for word, count in words.items()]
+
 # The 'reduce' function which will be executed in parallel.
-# The input is a list of tuples where the first element is a word and the second element is a number.
+# It is called once for every word, with the word and an iterator over the counts emitted for it.
 # The output is a list of tuples where the first element is a word and the second element is the total count of that word.
-# For example, the input [('hello', 1), ('world', 1), ('hello', 1)] should return [('hello', 2), ('world', 1)].
+# For example, reducer('hello', iter([1, 1])) should return [('hello', 2)].
 # For other use-cases, the logic will be different, but the input/output format and semantics should remain the same
 # Note for example that the partitioner logic expects to partition based on a key, so the output should be a list of tuples where the first element is the key.
 # Also, the serializer expects the data to be in key/value pair format. The value can be any serializable data form, such as a list
-# Thus, the mapper and reducer can use data with more than two elements, by using the first element as the key and the rest as the value 
-def reducer(data):
-    words = {}
-    for entry in data:
-        word, count = entry                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                           
-        if word in words:
-            words[word] += count
-        else:
-            words[word] = count
-    return [[word, count] for word, count in words.items()]
-
+# Thus, the mapper and reducer can use data with more than two elements, by using the first element as the key and the rest as the value
+# A reducer with a single parameter is also supported, it then receives all tuples of its partition in one list
+def reducer(word, counts):
+    return [[word, sum(counts)]]